@@ -1,11 +1,30 @@
+import math
+import os
+import threading
 import time
 
-from dateutil import parser
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 
 import service
-from data_parser import EventType
+import wire_format
+from data_parser import parse_datetime
+from response_cache import ResponseCache
+
+# 超过 PARALLEL_SERIAL_CUTOFF 艘船的查询交给 PARALLEL_QUERY_WORKERS 个进程并行处理, 0 表示不开启
+PARALLEL_QUERY_WORKERS = 4
+PARALLEL_SERIAL_CUTOFF = 8
+
+# 序列化后响应的缓存, 按规范化后的查询参数缓存, 重新加载数据后自动失效
+RESPONSE_CACHE_ENTRIES = 256
+RESPONSE_CACHE_BYTES = 64 * 2 ** 20
+RESPONSE_CACHE_TTL = 300
+
+# model.py 训练后保存的船只嵌入索引, 文件存在时启动时加载, 供 /mc2/select_similar_vessels 使用
+EMBEDDING_INDEX_PATH = './ship_embedding.npz'
+# /mc2/suspect_scores 用模型打分时读取的模型参数
+MODEL_PATH = './model.pth'
 
 if __name__ == 'app':
     time1 = time.time()
@@ -14,45 +33,190 @@ if __name__ == 'app':
     time2 = time.time()
     print('load node:', len(service.node_list))
     print('load edge:', len(service.edge_list))
+    print('load transponder ping:', len(service.ping_table))
     print('cost time:', time2 - time1, 's')
+    if PARALLEL_QUERY_WORKERS > 0:
+        service.enable_parallel_queries(PARALLEL_QUERY_WORKERS, PARALLEL_SERIAL_CUTOFF)
+    if os.path.exists(EMBEDDING_INDEX_PATH):
+        service.load_embedding_index(EMBEDDING_INDEX_PATH)
+        print('load vessel embeddings:', len(service.embedding_index))
+
+
+def _finite(obj):
+    # NaN/inf 不是合法的 JSON (比如没有坐标的地点), 换成 null
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _finite(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(v) for v in obj]
+    return obj
+
+
+class FiniteJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        # 大多数响应没有 NaN, 只有序列化失败时才遍历替换
+        try:
+            return super().dumps(obj, allow_nan=False, **kwargs)
+        except ValueError:
+            return super().dumps(_finite(obj), allow_nan=False, **kwargs)
+
 
 app = Flask(__name__)
+app.json = FiniteJSONProvider(app)
 CORS(app)
 
+response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL)
+
+
+def parse_query(data):
+    start_time = parse_datetime(data['startTime'])
+    end_time = parse_datetime(data['endTime'])
+    vessel_id = data['selectedBoat']
+    company = data['selectedCompany']
+
+    vessel_id_list = [vessel_id] if vessel_id != '' else [vessel.id for vessel in
+                                                            service.select_fishing_vessel_by_company(company)]
+    return start_time, end_time, vessel_id_list
+
+
+def parse_simplify(data):
+    """
+    Optional path simplification parameters: "maxPoints" bounds the number of points per vessel, "tolerance" is the
+    Douglas-Peucker distance in map units. Returns keyword arguments for the path query functions.
+    """
+    options = {}
+    if data.get('maxPoints') not in (None, ''):
+        options['max_points'] = int(data['maxPoints'])
+        if options['max_points'] < 2:
+            raise ValueError('maxPoints must be at least 2')
+    if data.get('tolerance') not in (None, ''):
+        options['tolerance'] = float(data['tolerance'])
+        if options['tolerance'] < 0:
+            raise ValueError('tolerance must not be negative')
+    return options
+
+
+# 支持 parse_simplify 参数的路由
+SIMPLIFY_ROUTES = {'select_transponder_ping'}
+
+# 路由名 -> 多艘船的查询函数, Flask 和 asgi.py 共用
+QUERY_ROUTES = {
+    'select_transponder_ping': service.select_vessel_paths,
+    'select_dwell': service.select_vessel_dwells,
+    'select_dwell_window': service.select_vessel_dwell_windows,
+}
+
+
+# 路由名 -> 返回 wire_format 二进制响应的函数
+BINARY_ROUTES = {
+    'select_transponder_ping': lambda *args, **options: wire_format.encode_paths(
+        service.select_vessel_path_columns(*args, **options)),
+    'select_dwell': lambda *args: wire_format.encode_dwells(service.select_vessel_dwells(*args)),
+    'select_dwell_window': lambda *args: wire_format.encode_dwells(service.select_vessel_dwell_windows(*args)),
+}
+
+
+def query_body(route, data, binary=False):
+    """
+    Runs a /mc2 query route and returns the serialized body, from the response cache when possible.
+
+    The body is JSON, or the wire_format columnar encoding when binary is set.
+    """
+    start_time, end_time, vessel_id_list = parse_query(data)
+    options = parse_simplify(data) if route in SIMPLIFY_ROUTES else {}
+    # 公司会被展开成船的列表, 所以按公司查询和逐艘船查询共用同一个键
+    key = (route, binary, start_time.isoformat(), end_time.isoformat(), tuple(vessel_id_list),
+           tuple(sorted(options.items())))
+    version = service.data_version
+    body = response_cache.get(key, version)
+    if body is None:
+        if binary:
+            body = BINARY_ROUTES[route](vessel_id_list, start_time, end_time, **options)
+        else:
+            body = app.json.dumps(QUERY_ROUTES[route](vessel_id_list, start_time, end_time, **options)).encode(
+                'utf-8')
+        response_cache.put(key, version, body)
+    return body
+
+
+# 支持流式返回的路由, 每艘船的结果算完就发送, 不经过响应缓存
+STREAM_ROUTES = {
+    'select_transponder_ping': service.iter_vessel_paths,
+    'select_dwell': service.iter_vessel_dwells,
+}
+STREAM_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'array': 'application/json',
+}
+
+
+def response_mode(route, data, accept):
+    """
+    Picks how a query route answers, from the payload and the Accept header:
+
+    - 'binary': "format": "binary" or Accept: application/vnd.mc2.columnar, the wire_format columnar body
+    - 'ndjson': "stream": "ndjson" or Accept: application/x-ndjson, one JSON object per vessel per line
+    - 'array': "stream": "array", a JSON array sent element by element
+    - None: the default JSON body
+    """
+    accept = accept or ''
+    if data.get('format') == 'binary' or wire_format.MIMETYPE in accept:
+        return 'binary'
+    if route not in STREAM_ROUTES:
+        return None
+    mode = data.get('stream')
+    if mode in STREAM_MIMETYPES:
+        return mode
+    if 'application/x-ndjson' in accept:
+        return 'ndjson'
+    return None
+
+
+def _stream_chunks(items, mode):
+    if mode == 'ndjson':
+        for item in items:
+            yield app.json.dumps(item) + '\n'
+        return
+    yield '['
+    for i, item in enumerate(items):
+        yield (',' if i else '') + app.json.dumps(item)
+    yield ']'
+
+
+def stream_chunks(route, data, mode):
+    # 先解析参数, 参数错误时还能正常返回错误码
+    start_time, end_time, vessel_id_list = parse_query(data)
+    options = parse_simplify(data) if route in SIMPLIFY_ROUTES else {}
+    return _stream_chunks(STREAM_ROUTES[route](vessel_id_list, start_time, end_time, **options), mode)
+
+
+def query_response(route, data):
+    # 先检查参数, 参数错误 (比如 maxPoints 不是整数) 返回 400, 与 asgi.py 一致; 之后的错误仍然是 500
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Bad query: expected a JSON object'}), 400
+    try:
+        parse_query(data)
+        if route in SIMPLIFY_ROUTES:
+            parse_simplify(data)
+        mode = response_mode(route, data, request.headers.get('Accept'))
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'error': 'Bad query: %s' % e}), 400
+
+    if mode == 'binary':
+        return app.response_class(query_body(route, data, binary=True), mimetype=wire_format.MIMETYPE)
+    if mode is not None:
+        return app.response_class(stream_with_context(stream_chunks(route, data, mode)),
+                                  mimetype=STREAM_MIMETYPES[mode])
+    return app.response_class(query_body(route, data), mimetype='application/json')
+
+
 @app.route('/mc2/select_transponder_ping', methods=['POST'])
 def select_transponder_ping():  # put application's code here
     data = request.get_json()
     # data = {'startTime': '2035-09-15', 'endTime': '2035-9-29', 'queryType': '1', 'selectedCompany': 'WestRiver Shipping KgaA', 'selectedBoat': 'perchplundererbc0'}
 
-    start_time = parser.parse(data['startTime'])
-    end_time = parser.parse(data['endTime'])
-    vessel_id = data['selectedBoat']
-    company = data['selectedCompany']
-
-    results = service.select_edge_attribute(EventType.TransportEvent_TransponderPing, attribute='time',
-                                            func=lambda x: start_time <= x <= end_time
-                                            )
-
-    vessel_id_list = [vessel_id] if vessel_id is not '' else [vessel.id for vessel in
-                                                                service.select_fishing_vessel_by_company(company)]
-
-    result = []
-    for vessel_id in vessel_id_list:
-        path = []
-        for ping in results:
-            if ping.target == vessel_id:
-                location_id = ping.source
-                geo_feature = service.select_geo_by_id(location_id)
-                time = ping.time
-                x, y = geo_feature.center()
-                path.append({'time': time, 'point': [x, y]})
-        result.append({
-            'vessel': vessel_id,
-            'path': path
-        })
-    for r in result:
-        r['path'] = sorted(r['path'], key=lambda t: t['time'])
-    return jsonify(result)
+    return query_response('select_transponder_ping', data)
 
 
 @app.route('/mc2/select_dwell', methods=['POST'])
@@ -60,37 +224,142 @@ def select_dwell():  # put application's code here
     data = request.get_json()
     # data = {'startTime': '2035-09-15', 'endTime': '2035-9-29', 'queryType': '1', 'selectedCompany': 'WestRiver Shipping KgaA', 'selectedBoat': 'perchplundererbc0'}
 
-    start_time = parser.parse(data['startTime'])
-    end_time = parser.parse(data['endTime'])
-    vessel_id = data['selectedBoat']
-    company = data['selectedCompany']
+    return query_response('select_dwell', data)
+
+
+@app.route('/mc2/select_dwell_window', methods=['POST'])
+def select_dwell_window():
+    # 与 /mc2/select_dwell 的请求和返回格式相同, 但用预先计算的前缀和求窗口内的总停留时间
+    data = request.get_json()
+    return query_response('select_dwell_window', data)
+
+
+def similar_vessels(data):
+    """
+    Answers {"selectedBoat": vessel id, "k": 10, "approximate": false} with the vessels most similar to it.
+
+    Returns (status code, body): 200 with the service.select_similar_vessels result, 400 for bad parameters, 404
+    for vessels without an embedding, or 503 when no embedding index is loaded.
+    """
+    if not isinstance(data, dict):
+        return 400, {'error': 'Bad query: expected a JSON object'}
+    vessel_id = data.get('selectedBoat')
+    if not vessel_id:
+        return 400, {'error': 'selectedBoat is required'}
+    approximate = data.get('approximate', False)
+    if not isinstance(approximate, bool):
+        return 400, {'error': 'Bad query: approximate must be true or false'}
+    try:
+        k = int(data.get('k', 10))
+        return 200, service.select_similar_vessels(vessel_id, k, approximate)
+    except (ValueError, TypeError) as e:
+        return 400, {'error': 'Bad query: %s' % e}
+    except KeyError:
+        return 404, {'error': 'No embedding for vessel %s' % vessel_id}
+    except RuntimeError as e:
+        return 503, {'error': str(e)}
+
+
+@app.route('/mc2/select_similar_vessels', methods=['POST'])
+def select_similar_vessels():
+    status, body = similar_vessels(request.get_json(silent=True) or {})
+    return jsonify(body), status
+
 
-    results = service.select_edge_attribute(EventType.TransportEvent_TransponderPing, attribute='time',
-                                            func=lambda x: start_time <= x <= end_time
-                                            )
-
-    vessel_id_list = [vessel_id] if vessel_id is not '' else [vessel.id for vessel in
-                                                                service.select_fishing_vessel_by_company(company)]
-
-    result = []
-    for vessel_id in vessel_id_list:
-        dwell_time = {}
-        for ping in results:
-            if ping.target == vessel_id:
-                location_id = ping.source
-                dwell = ping.dwell
-                geo_feature = service.select_geo_by_id(location_id)
-                x, y = geo_feature.center()
-                if location_id in dwell_time.keys():
-                    dwell_time[location_id]['time'] += dwell
-                else:
-                    dwell_time[location_id] = {'time': 0, 'x': x, 'y': y}
-        result.append({
-            'vessel': vessel_id,
-            'dwell': dwell_time
-        })
-    return jsonify(result)
+def suspect_scores(data, recompute=False):
+    """
+    Answers {"scorer": "dwell" or "model"} with the cached suspect scores of service.select_suspect_scores, which
+    are computed first when the model, the suspect list or the dataset changed.
 
+    Returns (status code, body): 200 with {'inputs', 'created', 'result', 'computed'}, 400 for an unknown scorer,
+    or 503 when model scoring is not possible here.
+    """
+    if not hasattr(data, 'get'):
+        return 400, {'error': 'Bad query: expected a JSON object'}
+    scorer = data.get('scorer') or 'dwell'
+    if scorer not in ('dwell', 'model'):
+        return 400, {'error': 'Unknown scorer %s' % scorer}
+    model_path = None
+    if scorer == 'model':
+        if not os.path.exists(MODEL_PATH):
+            return 503, {'error': 'No model at %s' % MODEL_PATH}
+        model_path = MODEL_PATH
+    try:
+        entry, computed = service.select_suspect_scores(model_path, recompute=recompute)
+    except ImportError as e:
+        return 503, {'error': 'Model scoring is not available: %s' % e}
+    except RuntimeError as e:
+        return 503, {'error': str(e)}
+    return 200, dict(entry, computed=computed)
+
+
+def warm_suspect_scores():
+    # 启动后在后台读取缓存, 数据或模型变了就重新计算, 第一次请求不用等
+    for scorer in ('dwell', 'model'):
+        try:
+            suspect_scores({'scorer': scorer})
+        except Exception as e:
+            print('suspect scores (%s):' % scorer, e)
+
+
+@app.route('/mc2/suspect_scores', methods=['GET', 'POST'])
+def select_suspect_scores():
+    # GET ?scorer=model 读取, POST {"scorer": ..., "recompute": true} 可以强制重新计算
+    if request.method == 'GET':
+        status, body = suspect_scores(request.args)
+    else:
+        data = request.get_json(silent=True) or {}
+        status, body = suspect_scores(data, isinstance(data, dict) and bool(data.get('recompute')))
+    return jsonify(body), status
+
+
+@app.route('/mc2/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(response_cache.stats())
+
+
+def reload_status():
+    graph = service.graph
+    return {
+        'running': service.reload_status['running'],
+        'error': service.reload_status['error'],
+        'version': graph.version,
+        'timings': graph.load_timings,
+    }
+
+
+def trigger_reload(wait):
+    """
+    Reloads the dataset from the files it was loaded from; queries are served from the old data until the swap.
+
+    Returns (status code, body): 200 with the new timings when wait is set, otherwise 202 while the reload runs in
+    the background, or 409 if a reload is already running.
+    """
+    if not wait:
+        if not service.start_reload():
+            return 409, {'error': 'A reload is already running'}
+        return 202, reload_status()
+    try:
+        service.reload()
+    except RuntimeError as e:
+        return 409, {'error': str(e)}
+    return 200, reload_status()
+
+
+@app.route('/mc2/admin/reload', methods=['GET', 'POST'])
+def admin_reload():
+    # GET 查看状态和上一次加载的耗时, POST 触发重新加载, {"wait": true} 时等加载完成再返回
+    if request.method == 'GET':
+        return jsonify(reload_status())
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Bad query: expected a JSON object'}), 400
+    status, body = trigger_reload(bool(data.get('wait')))
+    return jsonify(body), status
+
+
+if __name__ == 'app':
+    threading.Thread(target=warm_suspect_scores, daemon=True).start()
 
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,199 @@
+"""
+ASGI server mode exposing the same /mc2 routes as app.py.
+
+Run with an ASGI server, e.g. `uvicorn asgi:application --workers 1`. Importing app loads the dataset exactly as
+`flask run` does. Query work runs in a bounded thread pool so the event loop keeps accepting requests; at most
+MAX_CONCURRENT_QUERIES queries execute at once, up to MAX_QUEUED_QUERIES more wait, and anything beyond that is
+rejected with 503 and a Retry-After header instead of piling up. Streaming requests (see app.response_mode) hold
+their slot until the last vessel has been sent.
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import app
+import wire_format
+
+QUERY_THREADS = 4
+MAX_CONCURRENT_QUERIES = 4
+MAX_QUEUED_QUERIES = 64
+RETRY_AFTER_SECONDS = 1
+
+_CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'content-type'),
+    (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+]
+
+
+class QueryLimiter:
+    """Runs blocking query functions in a thread pool with a concurrency limit and a bounded wait queue."""
+
+    def __init__(self, threads, max_concurrent, max_queued):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='mc2-query')
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.semaphore = None
+        self.pending = 0
+
+    def overloaded(self):
+        return self.pending >= self.max_concurrent + self.max_queued
+
+    async def run(self, func, *args):
+        if self.semaphore is None:
+            # Semaphore 要在事件循环里创建
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.pending += 1
+        try:
+            async with self.semaphore:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def iterate(self, chunks):
+        # 流式响应占用一个并发名额直到最后一块发送完
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.pending += 1
+        try:
+            async with self.semaphore:
+                loop = asyncio.get_running_loop()
+                while True:
+                    chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+                    if chunk is None:
+                        return
+                    yield chunk
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+limiter = QueryLimiter(QUERY_THREADS, MAX_CONCURRENT_QUERIES, MAX_QUEUED_QUERIES)
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def _respond(send, status, body=b'', content_type=b'application/json', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+                   + _CORS_HEADERS + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _respond_stream(send, chunks, content_type):
+    # 不带 content-length, 由服务器按分块传输发送
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', content_type)] + _CORS_HEADERS,
+    })
+    async for chunk in limiter.iterate(chunks):
+        await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _error(message):
+    return json.dumps({'error': message}).encode('utf-8')
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            limiter.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    method = scope['method']
+    path = scope['path']
+    route = path[len('/mc2/'):] if path.startswith('/mc2/') else None
+
+    if method == 'OPTIONS':
+        return await _respond(send, 204)
+    if route == 'cache_stats' and method == 'GET':
+        return await _respond(send, 200, json.dumps(app.response_cache.stats()).encode('utf-8'))
+    if route == 'admin/reload' and method == 'GET':
+        return await _respond(send, 200, json.dumps(app.reload_status()).encode('utf-8'))
+    if route == 'admin/reload' and method == 'POST':
+        body = await _read_body(receive)
+        try:
+            wait = bool(body and json.loads(body).get('wait'))
+        except (ValueError, AttributeError) as e:
+            return await _respond(send, 400, _error('Bad query: %s' % e))
+        # 加载在默认线程池里进行, 不占用查询的并发名额
+        status, result = await asyncio.get_running_loop().run_in_executor(None, app.trigger_reload, wait)
+        return await _respond(send, status, app.app.json.dumps(result).encode('utf-8'))
+    if route == 'suspect_scores' and method in ('GET', 'POST'):
+        if method == 'GET':
+            data, recompute = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'))), False
+        else:
+            body = await _read_body(receive)
+            try:
+                data = json.loads(body) if body else {}
+            except ValueError as e:
+                return await _respond(send, 400, _error('Bad query: %s' % e))
+            recompute = isinstance(data, dict) and bool(data.get('recompute'))
+        status, result = await limiter.run(app.suspect_scores, data, recompute)
+        return await _respond(send, status, app.app.json.dumps(result).encode('utf-8'))
+    if route == 'select_similar_vessels' and method == 'POST':
+        body = await _read_body(receive)
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            return await _respond(send, 400, _error('Bad query: %s' % e))
+        status, result = await limiter.run(app.similar_vessels, data)
+        return await _respond(send, status, app.app.json.dumps(result).encode('utf-8'))
+    if route not in app.QUERY_ROUTES:
+        return await _respond(send, 404, _error('Not found'))
+    if method != 'POST':
+        return await _respond(send, 405, _error('Method not allowed'))
+
+    body = await _read_body(receive)
+    if limiter.overloaded():
+        return await _respond(send, 503, _error('Too many queued queries'),
+                              headers=[(b'retry-after', str(RETRY_AFTER_SECONDS).encode())])
+    try:
+        data = json.loads(body)
+        if not isinstance(data, dict):
+            return await _respond(send, 400, _error('Bad query: expected a JSON object'))
+        mode = app.response_mode(route, data, _header(scope, b'accept'))
+        if mode in app.STREAM_MIMETYPES:
+            chunks = await limiter.run(app.stream_chunks, route, data, mode)
+        else:
+            result = await limiter.run(app.query_body, route, data, mode == 'binary')
+    except (ValueError, KeyError, TypeError) as e:
+        return await _respond(send, 400, _error('Bad query: %s' % e))
+    if mode in app.STREAM_MIMETYPES:
+        return await _respond_stream(send, chunks, app.STREAM_MIMETYPES[mode].encode())
+    if mode == 'binary':
+        return await _respond(send, 200, result, content_type=wire_format.MIMETYPE.encode())
+    await _respond(send, 200, result)
@@ -0,0 +1,87 @@
+"""
+Closed-loop load test for the /mc2 query routes: N clients each send requests back to back, and the script reports
+throughput and latency percentiles.
+
+Run it once against the Flask server and once against the ASGI server to compare, e.g.
+
+    flask run --port 5000                       # then: python -m benchmarks.load_test http://127.0.0.1:5000
+    uvicorn asgi:application --port 8000        # then: python -m benchmarks.load_test http://127.0.0.1:8000
+
+Pass --no-cache-bust to let the response cache answer repeated payloads.
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from datetime import date, timedelta
+from urllib.parse import urlsplit
+
+DEFAULT_PAYLOADS = [
+    {'startTime': '2035-09-15', 'endTime': '2035-9-29', 'queryType': '1', 'selectedCompany': 'WestRiver Shipping KgaA',
+     'selectedBoat': ''},
+    {'startTime': '2035-02-01', 'endTime': '2035-12-31', 'queryType': '1', 'selectedCompany': 'WestRiver Shipping KgaA',
+     'selectedBoat': 'perchplundererbc0'},
+]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def run_client(url, route, payloads, requests_per_client, cache_bust, client_id, latencies, statuses):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=300)
+    for i in range(requests_per_client):
+        payload = dict(payloads[i % len(payloads)])
+        if cache_bust:
+            # 每个请求的结束时间都不同, 避免命中响应缓存
+            end = date(2035, 12, 31) - timedelta(days=(client_id * requests_per_client + i) % 300)
+            payload['endTime'] = end.isoformat()
+        body = json.dumps(payload)
+        t1 = time.perf_counter()
+        conn.request('POST', '/mc2/' + route, body=body, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - t1)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+    conn.close()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('url', help='server base url, e.g. http://127.0.0.1:5000')
+    arg_parser.add_argument('--route', default='select_transponder_ping')
+    arg_parser.add_argument('--clients', type=int, default=16)
+    arg_parser.add_argument('--requests', type=int, default=20, help='requests per client')
+    arg_parser.add_argument('--payloads', help='json file with a list of request payloads')
+    arg_parser.add_argument('--no-cache-bust', dest='cache_bust', action='store_false')
+    args = arg_parser.parse_args()
+
+    payloads = DEFAULT_PAYLOADS
+    if args.payloads:
+        with open(args.payloads) as f:
+            payloads = json.load(f)
+
+    latencies = []
+    statuses = {}
+    threads = [threading.Thread(target=run_client, args=(args.url, args.route, payloads, args.requests,
+                                                         args.cache_bust, i, latencies, statuses))
+               for i in range(args.clients)]
+    t1 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t1
+
+    latencies.sort()
+    print('clients: %d, requests: %d, elapsed: %.2f s' % (args.clients, len(latencies), elapsed))
+    print('status codes:', statuses)
+    print('throughput: %.1f req/s' % (len(latencies) / elapsed))
+    print('latency p50: %.1f ms, p90: %.1f ms, p99: %.1f ms, max: %.1f ms' % (
+        percentile(latencies, 50) * 1e3, percentile(latencies, 90) * 1e3, percentile(latencies, 99) * 1e3,
+        latencies[-1] * 1e3 if latencies else float('nan')))
@@ -0,0 +1,75 @@
+"""
+Memory used by the parsed MC2 graph with the __slots__ entity/event classes, compared with the same objects
+stored in per-instance __dict__s (the layout the classes had before), and with the columnar ping table.
+
+Usage: python -m benchmarks.memory [path/to/mc2.json]
+"""
+import copy
+import gc
+import sys
+import tracemalloc
+
+from data_parser import iter_json_arrays, parse_edge, parse_node
+from ping_table import PingTable, ping_columns
+
+
+class _DictRecord:
+    pass
+
+
+def _fields(obj):
+    names = []
+    for cls in type(obj).__mro__:
+        names.extend(getattr(cls, '__slots__', ()))
+    return names
+
+
+def as_dict_record(obj):
+    record = _DictRecord()
+    record.__dict__.update({name: getattr(obj, name) for name in _fields(obj)})
+    return record
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def report(name, size, count):
+    print('%-32s %10.1f MB %8.1f bytes/object' % (name, size / 2 ** 20, size / max(count, 1)))
+
+
+if __name__ == '__main__':
+    data_file_path = sys.argv[1] if len(sys.argv) > 1 else './data/MC2/mc2.json'
+    nodes = []
+    links = []
+    for key, record in iter_json_arrays(data_file_path, ('nodes', 'links')):
+        (nodes if key == 'nodes' else links).append(record)
+    print('nodes:', len(nodes), 'links:', len(links))
+
+    # 只统计解析出来的对象本身, 原始 json 在测量前已经加载好
+    objects, graph_size = measure(lambda: [parse_node(n) for n in nodes] + [parse_edge(e) for e in links])
+    report('parsed graph, all objects', graph_size, len(objects))
+
+    # 两种布局共享同样的属性值, 这里只比较对象本身的开销
+    _, slots_size = measure(lambda: [copy.copy(o) for o in objects])
+    report('  __slots__ instances', slots_size, len(objects))
+    _, dict_size = measure(lambda: [as_dict_record(o) for o in objects])
+    report('  __dict__ instances (previous)', dict_size, len(objects))
+    print('instance saving: %.1f%%, %.1f MB' % (100 * (1 - slots_size / dict_size), (dict_size - slots_size) / 2 ** 20))
+
+    del objects
+    pings = [e for e in links if e['type'] == 'Event.TransportEvent.TransponderPing']
+
+    def build_table():
+        table = PingTable()
+        table.extend(ping_columns(pings))
+        table.build_index()
+        return table
+
+    _, table_size = measure(build_table)
+    report('PingTable (transponder pings)', table_size, len(pings))
@@ -0,0 +1,48 @@
+"""
+Per-record timestamp parse cost, dateutil versus the data_parser fast path.
+
+Usage: python -m benchmarks.parse_timestamps [path/to/mc2.json]
+"""
+import itertools
+import sys
+import time
+
+from dateutil import parser
+
+from data_parser import iter_json_arrays, parse_datetime, parse_datetime_array
+
+TIME_FIELDS = ('time', 'date', '_last_edited_date', '_date_added')
+
+
+def load_timestamps(data_file_path, limit):
+    values = []
+    for _, record in iter_json_arrays(data_file_path, ('nodes', 'links')):
+        values.extend(record[field] for field in TIME_FIELDS if record.get(field) is not None)
+        if len(values) >= limit:
+            break
+    return values[:limit]
+
+
+def bench(name, func, values, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        func(values)
+        best = min(best, time.perf_counter() - t1)
+    print('%-28s %8.3f us/record' % (name, best / len(values) * 1e6))
+    return best
+
+
+if __name__ == '__main__':
+    data_file_path = sys.argv[1] if len(sys.argv) > 1 else './data/MC2/mc2.json'
+    values = load_timestamps(data_file_path, limit=200000)
+    print('timestamps:', len(values))
+
+    # 快速路径必须和 dateutil 的结果完全一致
+    for value in itertools.islice(values, 10000):
+        assert parse_datetime(value) == parser.parse(value), value
+
+    before = bench('dateutil parser.parse', lambda vs: [parser.parse(v) for v in vs], values)
+    after = bench('parse_datetime', lambda vs: [parse_datetime(v) for v in vs], values)
+    batch = bench('parse_datetime_array', parse_datetime_array, values)
+    print('speedup: %.1fx per record, %.1fx batched' % (before / after, before / batch))
@@ -0,0 +1,41 @@
+"""
+Timing of the training-sequence builders on the dataset: preprocess_data on the select_transponder_ping dicts versus
+preprocess_arrays on the select_transponder_ping_arrays columns. tests/test_preprocess.py checks that both give the
+same output, e.g.
+
+    python -m benchmarks.preprocess ./data/MC2/mc2.json --geo "./data/MC2/Oceanus Information/Oceanus Geography.geojson"
+"""
+import argparse
+import time
+
+import service
+from model import preprocess_arrays, preprocess_data
+
+
+def timed(func, *args):
+    t1 = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - t1
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('data_file_path')
+    arg_parser.add_argument('--geo', dest='geo_file_path')
+    arg_parser.add_argument('--max-len', type=int, default=128)
+    args = arg_parser.parse_args()
+
+    service.initialize(args.data_file_path, geo_file_path=args.geo_file_path)
+    vocab_mapping = {k: v + 1 for v, k in enumerate(service.id2location.keys())}
+    ship_mapping = {k: v for v, k in enumerate(service.id2vessel.keys())}
+
+    for time_interval in (3600, 600):
+        transponderpings_dict, dicts = timed(service.select_transponder_ping)
+        _, legacy = timed(preprocess_data, transponderpings_dict, vocab_mapping, ship_mapping, time_interval,
+                          args.max_len)
+        (ping_arrays, location_ids), columns = timed(service.select_transponder_ping_arrays)
+        _, arrays = timed(preprocess_arrays, ping_arrays, location_ids, vocab_mapping, ship_mapping, time_interval,
+                          args.max_len)
+        print('interval %5d: select_transponder_ping %.3fs + preprocess_data %.3fs, '
+              'select_transponder_ping_arrays %.3fs + preprocess_arrays %.3fs (%.1fx)'
+              % (time_interval, dicts, legacy, columns, arrays, (dicts + legacy) / (columns + arrays)))
@@ -0,0 +1,46 @@
+"""
+Suspect scoring cost, the per-vessel cal_suspect_ratio loop versus the batched suspect_ratios.
+
+Uses a randomly initialized model with the cal_suspect hyperparameters, so no trained weights or dataset are needed.
+
+Usage: python -m benchmarks.suspect_scoring [num_threads]
+"""
+import sys
+import time
+
+import torch
+
+import cal_suspect
+from model import ShipRoutePredictor, get_ship_embedding
+
+
+def bench(name, func, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t1 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t1)
+    print('%-16s %10.3f ms' % (name, best * 1e3))
+    return result, best
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        torch.set_num_threads(int(sys.argv[1]))
+    torch.manual_seed(0)
+    model = ShipRoutePredictor(vocab_size=cal_suspect.vocab_size, embed_dim=cal_suspect.embed_dim,
+                               num_heads=cal_suspect.num_heads, num_layers=cal_suspect.num_layers,
+                               num_ships=cal_suspect.num_ships, dropout=cal_suspect.dropout,
+                               max_seq_len=cal_suspect.max_length)
+    ship_ids = list(range(cal_suspect.num_ships))
+    num_suspects = len(cal_suspect.suspect_ship)
+    suspect_ship_ids = ship_ids[::len(ship_ids) // num_suspects][:num_suspects]
+    print('ships: %d, suspects: %d, threads: %d' % (len(ship_ids), len(suspect_ship_ids), torch.get_num_threads()))
+
+    def loop():
+        suspect_ship_embedding = get_ship_embedding(model, suspect_ship_ids)
+        return torch.stack([cal_suspect.cal_suspect_ratio(model, i, suspect_ship_embedding) for i in ship_ids])
+
+    expected, t_loop = bench('per-vessel loop', loop)
+    actual, t_batch = bench('batched', lambda: cal_suspect.suspect_ratios(model, ship_ids, suspect_ship_ids))
+    print('speedup: %.1fx, max abs diff: %.2e' % (t_loop / t_batch, (expected - actual).abs().max().item()))
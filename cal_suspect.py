@@ -16,24 +16,19 @@ num_ships = 296
 dropout = 0.1
 max_length = 127
 
-suspect_ship = [
-    'plaiceplundererba1',
-    'europeanseabassbuccaneer777',
-    'pompanoplunderere5d',
-    'roachrobberdb6',
-    'whitemarlinwranglerbac',
-    'huron1b3',
-    'opheliacac',
-    'wavewranglerc2d',
-    'bigeyetunabanditb73',
-    'arcticgraylingangler094',
-    'channelcatfishcapturer175',
-    'snappersnatcher7be'
-]
-
-
-def cal_suspect_ratio(target_id):
-    target_embedding = get_ship_embedding(m, target_id)
+suspect_ship = service.SUSPECT_VESSELS
+
+
+def load_model(model_path):
+    model = ShipRoutePredictor(vocab_size=vocab_size, embed_dim=embed_dim, num_heads=num_heads, num_layers=num_layers,
+                               num_ships=num_ships, dropout=dropout, max_seq_len=max_length)
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    return model
+
+
+def cal_suspect_ratio(model, target_id, suspect_ship_embedding):
+    # 单艘船的打分, 保留用于对照 suspect_ratios
+    target_embedding = get_ship_embedding(model, target_id)
     sim_with_suspect = suspect_ship_embedding @ target_embedding
     sim_with_suspect = sim_with_suspect.softmax(dim=-1)
 
@@ -43,33 +38,69 @@ def cal_suspect_ratio(target_id):
     return sim
 
 
-def cal_suspect():
+def suspect_ratios(model, ship_ids, suspect_ship_ids):
+    """
+    Suspect ratios of many ships in one set of tensor operations; element i equals
+    cal_suspect_ratio(model, ship_ids[i], get_ship_embedding(model, suspect_ship_ids)).
+
+    Args:
+        model (ShipRoutePredictor): Trained model, on any device.
+        ship_ids (list): Ship embedding rows to score.
+        suspect_ship_ids (list): Ship embedding rows of the known suspects.
+
+    Returns:
+        (len(ship_ids),) CPU tensor.
+    """
+    target_embedding = get_ship_embedding(model, ship_ids)
+    suspect_ship_embedding = get_ship_embedding(model, suspect_ship_ids)
+    # (N, K) 每艘船对每个可疑船的权重, 再混合出 (N, D) 的可疑船向量
+    sim_with_suspect = (target_embedding @ suspect_ship_embedding.T).softmax(dim=-1)
+    suspect_blend_embedding = sim_with_suspect @ suspect_ship_embedding
+    sim = torch.cosine_similarity(target_embedding, suspect_blend_embedding, dim=1)
+    sim = (torch.exp(sim + 1) - 1) / (math.e ** 2 - 1)
+    return sim.cpu()
+
+
+def cal_suspect(model, ship_mapping, vessels=None, suspects=suspect_ship, output_path=None):
+    """
+    Scores fishing vessels against the known suspects and groups the ratios by company.
+
+    Args:
+        model (ShipRoutePredictor): Trained model.
+        ship_mapping (dict): Vessel id -> ship embedding row, as used in training.
+        vessels (list): Vessels to score, defaults to every fishing vessel in service.
+        suspects (list): Vessel ids of the known suspects.
+        output_path (str): Also write the result as JSON to this path, e.g. 'suspect.json'.
+
+    Returns:
+        {company: {'suspect_ratio': max over its vessels, 'vessels': {vessel id: ratio}}}
+    """
+    if vessels is None:
+        vessels = [v for v in service.id2vessel.values() if v.type == EntityType.Vessel_FishingVessel]
+    vessels = [v for v in vessels if v.company != 'SouthSeafood Express Corp']
+    ratios = suspect_ratios(model, [ship_mapping[v.id] for v in vessels],
+                            [ship_mapping[i] for i in suspects]).tolist()
+
     result = {}
-    for vessel in service.id2vessel.values():
-        if vessel.type == EntityType.Vessel_FishingVessel:
-            company = vessel.company
-            v_id = vessel.id
-            if company == 'SouthSeafood Express Corp':
-                continue
-            if company not in result.keys():
-                result[company] = {'suspect_ratio': 0, 'vessels': {}}
-            suspect_ratio = cal_suspect_ratio(ship_mapping[v_id]).item()
-            result[company]['suspect_ratio'] = max(result[company]['suspect_ratio'], suspect_ratio)
-            result[company]['vessels'][v_id] = suspect_ratio
-    with open('suspect.json', 'w') as json_file:
-        json.dump(result, json_file, indent=4)
+    for vessel, suspect_ratio in zip(vessels, ratios):
+        company = vessel.company
+        if company not in result.keys():
+            result[company] = {'suspect_ratio': 0, 'vessels': {}}
+        result[company]['suspect_ratio'] = max(result[company]['suspect_ratio'], suspect_ratio)
+        result[company]['vessels'][vessel.id] = suspect_ratio
+    if output_path is not None:
+        with open(output_path, 'w') as json_file:
+            json.dump(result, json_file, indent=4)
+    return result
 
 
 if __name__ == '__main__':
-    m = ShipRoutePredictor(vocab_size=vocab_size, embed_dim=embed_dim, num_heads=num_heads, num_layers=num_layers,
-                           num_ships=num_ships, dropout=dropout, max_seq_len=max_length)
-    m.load_state_dict(torch.load('model.pth'))
     t1 = time.time()
     service.initialize('./data/MC2/mc2.json', geo_file_path='./data/MC2/Oceanus Information/Oceanus Geography.geojson')
     t2 = time.time()
     print('Cost ', t2 - t1, 's')
-    ship_mapping = {k: v for v, k in enumerate(service.id2vessel.keys())}
-    suspect_ship_id = [ship_mapping[i] for i in suspect_ship]
-
-    suspect_ship_embedding = get_ship_embedding(m, suspect_ship_id)
-    cal_suspect()
\ No newline at end of file
+    # 模型和数据都没变时直接使用缓存的分数
+    entry, computed = service.select_suspect_scores(model_path='model.pth')
+    print('computed' if computed else 'cached', entry['inputs'])
+    with open('suspect.json', 'w') as json_file:
+        json.dump(entry['result'], json_file, indent=4)
@@ -1,5 +1,7 @@
 from data_parser.edge_parser import parse_edge
-from data_parser.metadata_parser import parse_metadata
+from data_parser.metadata_parser import parse_metadata, metadata_fields, Metadata
 from data_parser.node_parser import parse_node
 from data_parser.type_parser import parse_type, EntityType, EventType
-from data_parser.geo_parser import parse_geo_object, GeoFeature
+from data_parser.geo_parser import parse_geo_object, compute_centroids, GeoFeature
+from data_parser.time_parser import parse_datetime, parse_datetime_array
+from data_parser.stream_parser import iter_json_arrays, iter_json_batches
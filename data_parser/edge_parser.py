@@ -1,23 +1,36 @@
 from data_parser.type_parser import EventType, parse_type
-from data_parser.metadata_parser import parse_metadata
-from dateutil import parser
+from data_parser.metadata_parser import Metadata, metadata_fields
+from data_parser.time_parser import parse_datetime
 
 class Event:
+    __slots__ = ('type', '_metadata', 'source', 'target', 'key')
+
     def __init__(self, event_type, metadata, source, target, key):
         self.type = event_type
-        self.metadata = metadata
+        # metadata 可以是 Metadata 对象, 也可以是 metadata_fields 返回的原始元组
+        self._metadata = metadata
         self.source = source
         self.target = target
         self.key = key
 
+    @property
+    def metadata(self):
+        if isinstance(self._metadata, tuple):
+            self._metadata = Metadata(*self._metadata)
+        return self._metadata
+
 
 class Transaction(Event):
+    __slots__ = ('date',)
+
     def __init__(self, metadata, date, source, target, key):
         super(Transaction, self).__init__(EventType.Transaction, metadata, source, target, key)
         self.date = date
 
 
 class HarborReport(Event):
+    __slots__ = ('date', 'data_author', 'aphorism', 'holiday_greeting', 'wisdom', 'saying')
+
     def __init__(self, metadata, date, data_author, aphorism, holiday_greeting, wisdom, saying, source, target, key):
         super(HarborReport, self).__init__(EventType.HarborReport, metadata, source, target, key)
         self.date = date
@@ -29,6 +42,8 @@ class HarborReport(Event):
 
 
 class TransponderPing(Event):
+    __slots__ = ('time', 'dwell')
+
     def __init__(self, metadata, time, dwell, source, target, key):
         super(TransponderPing, self).__init__(EventType.TransportEvent_TransponderPing, metadata, source, target, key)
         self.time = time
@@ -37,11 +52,11 @@ class TransponderPing(Event):
 
 def parse_edge(json_node):
     edge_type = parse_type(json_node['type'])
-    metadata = parse_metadata(json_node)
+    metadata = metadata_fields(json_node)
     date = json_node.get('date', None)
-    date = parser.parse(date) if date is not None else None
+    date = parse_datetime(date) if date is not None else None
     time = json_node.get('time', None)
-    time = parser.parse(time) if time is not None else None
+    time = parse_datetime(time) if time is not None else None
     dwell = json_node.get('dwell', None)
     data_author = json_node.get('data_author', None)
     aphorism = json_node.get('aphorism', None)
@@ -1,34 +1,90 @@
+import numpy as np
+
+
 class GeoFeature:
     def __init__(self, geo_name, geo_type, polygon):
         self.id = geo_name
         self.type = geo_type
         self.polygon = polygon
+        self.centroid = None
 
     def center(self):
-        centroid_x, centroid_y = 0, 0
-        if self.type == 'Polygon':
-            area = 0
-            centroid_x = 0
-            centroid_y = 0
-            num_points = len(self.polygon[0])
+        # 正常情况下 centroid 在读取 geojson 时已经由 compute_centroids 批量算好
+        if self.centroid is None:
+            compute_centroids([self])
+        return self.centroid
+
+
+def _polygons(feature):
+    if feature.type == 'Polygon':
+        return [feature.polygon]
+    if feature.type == 'MultiPolygon':
+        return feature.polygon
+    return []
+
+
+def compute_centroids(features):
+    """
+    Computes the centroid of every feature at once and caches it on feature.centroid.
 
-            for i in range(num_points):
-                x1, y1 = self.polygon[0][i]
-                x2, y2 = self.polygon[0][(i + 1) % num_points]
-                partial_area = x1 * y2 - x2 * y1
-                area += partial_area
-                centroid_x += (x1 + x2) * partial_area
-                centroid_y += (y1 + y2) * partial_area
+    Polygon rings are evaluated with a single vectorized shoelace pass. The first ring of each polygon is the
+    outer boundary and the following rings are holes, whose area is subtracted whatever their winding order.
+    MultiPolygon parts are combined by area. Degenerate polygons fall back to the mean of their vertices.
 
-            area /= 2
-            centroid_x /= (6 * area)
-            centroid_y /= (6 * area)
+    Args:
+        features (list of GeoFeature): Features to compute.
 
+    Returns:
+        np.ndarray: (len(features), 2) array of centroid coordinates, in the order of features.
+    """
+    centers = np.zeros((len(features), 2), dtype=np.float64)
+    rings = []
+    ring_feature = []
+    ring_sign = []
+    for i, feature in enumerate(features):
+        if feature.type == 'Point':
+            centers[i] = feature.polygon[:2]
+        elif feature.type == 'MultiPoint':
+            centers[i] = np.asarray(feature.polygon, dtype=np.float64)[:, :2].mean(axis=0)
+        for polygon in _polygons(feature):
+            for k, ring in enumerate(polygon):
+                rings.append(np.asarray(ring, dtype=np.float64)[:, :2])
+                ring_feature.append(i)
+                ring_sign.append(1 if k == 0 else -1)
 
-        elif self.type == 'Point':
-            centroid_x += self.polygon[0]
-            centroid_y += self.polygon[1]
-        return centroid_x, centroid_y
+    if rings:
+        lengths = np.array([len(r) for r in rings])
+        points = np.concatenate(rings)
+        ring_id = np.repeat(np.arange(len(rings)), lengths)
+        starts = np.cumsum(lengths) - lengths
+        # 每个顶点在同一个环中的下一个顶点, 环尾接回环首
+        next_idx = np.arange(len(points)) + 1
+        next_idx[starts + lengths - 1] = starts
+
+        x1, y1 = points[:, 0], points[:, 1]
+        x2, y2 = points[next_idx, 0], points[next_idx, 1]
+        partial_area = x1 * y2 - x2 * y1
+        area = np.bincount(ring_id, partial_area, minlength=len(rings)) / 2
+        moment_x = np.bincount(ring_id, (x1 + x2) * partial_area, minlength=len(rings)) / 6
+        moment_y = np.bincount(ring_id, (y1 + y2) * partial_area, minlength=len(rings)) / 6
+
+        # 外环面积取正, 洞取负, 与环的方向无关
+        sign = np.where(area < 0, -1.0, 1.0) * np.array(ring_sign)
+        ring_feature = np.array(ring_feature)
+        total_area = np.bincount(ring_feature, area * sign, minlength=len(features))
+        total_x = np.bincount(ring_feature, moment_x * sign, minlength=len(features))
+        total_y = np.bincount(ring_feature, moment_y * sign, minlength=len(features))
+
+        has_rings = np.bincount(ring_feature, minlength=len(features)) > 0
+        valid = has_rings & (total_area != 0)
+        centers[valid, 0] = total_x[valid] / total_area[valid]
+        centers[valid, 1] = total_y[valid] / total_area[valid]
+        for i in np.flatnonzero(has_rings & ~valid):
+            centers[i] = points[np.isin(ring_id, np.flatnonzero(ring_feature == i))].mean(axis=0)
+
+    for feature, (x, y) in zip(features, centers.tolist()):
+        feature.centroid = (x, y)
+    return centers
 
 
 def parse_geo_object(json):
@@ -38,4 +94,3 @@ def parse_geo_object(json):
     # 如果是point就只有一个值 polygon就有多个值
     polygon = json['geometry']['coordinates']
     return GeoFeature(geo_name, geo_type, polygon)
-
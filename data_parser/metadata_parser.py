@@ -1,18 +1,35 @@
-from dateutil import parser
+from data_parser.time_parser import parse_datetime
+
 
 class Metadata:
+    __slots__ = ('last_edited_by', '_last_edited_date', '_date_added', 'raw_source', 'algorithm')
+
     def __init__(self, last_edited_by, last_edited_date, date_added, raw_source, algorithm):
         self.last_edited_by = last_edited_by
-        self.last_edited_date = last_edited_date
-        self.date_added = date_added
+        # 两个日期可以先保存原始字符串, 第一次访问时再解析
+        self._last_edited_date = last_edited_date
+        self._date_added = date_added
         self.raw_source = raw_source
         self.algorithm = algorithm
 
+    @property
+    def last_edited_date(self):
+        if isinstance(self._last_edited_date, str):
+            self._last_edited_date = parse_datetime(self._last_edited_date)
+        return self._last_edited_date
+
+    @property
+    def date_added(self):
+        if isinstance(self._date_added, str):
+            self._date_added = parse_datetime(self._date_added)
+        return self._date_added
+
+
+def metadata_fields(json_node):
+    # 未解码的元数据, Entity/Event 保存这个元组, 访问 .metadata 时才构造 Metadata
+    return (json_node['_last_edited_by'], json_node['_last_edited_date'], json_node['_date_added'],
+            json_node['_raw_source'], json_node['_algorithm'])
+
 
 def parse_metadata(json_node):
-    last_edited_by = json_node['_last_edited_by']
-    last_edited_date = parser.parse(json_node['_last_edited_date'])
-    date_added = parser.parse(json_node['_date_added'])
-    raw_source = json_node['_raw_source']
-    algorithm = json_node['_algorithm']
-    return Metadata(last_edited_by, last_edited_date, date_added, raw_source, algorithm)
+    return Metadata(*metadata_fields(json_node))
@@ -1,14 +1,25 @@
 from data_parser.type_parser import EntityType, parse_type
-from data_parser.metadata_parser import parse_metadata
-from dateutil import parser
+from data_parser.metadata_parser import Metadata, metadata_fields
+from data_parser.time_parser import parse_datetime
 
 class Entity:
+    __slots__ = ('type', '_metadata')
+
     def __init__(self, entity_type, metadata):
         self.type = entity_type
-        self.metadata = metadata
+        # metadata 可以是 Metadata 对象, 也可以是 metadata_fields 返回的原始元组
+        self._metadata = metadata
+
+    @property
+    def metadata(self):
+        if isinstance(self._metadata, tuple):
+            self._metadata = Metadata(*self._metadata)
+        return self._metadata
 
 
 class Vessel(Entity):
+    __slots__ = ('flag_country', 'name', 'id')
+
     def __init__(self, vessel_type, metadata, flag_country, name, vessel_id):
         super(Vessel, self).__init__(vessel_type, metadata)
         self.flag_country = flag_country
@@ -17,68 +28,63 @@ class Vessel(Entity):
 
 
 class CargoVessel(Vessel):
+    __slots__ = ('tonnage', 'length_overall')
+
     def __init__(self, metadata, flag_country, tonnage, name, length_overall, vessel_id):
         super(CargoVessel, self).__init__(EntityType.Vessel_CargoVessel, metadata, flag_country, name, vessel_id)
-        self.flag_country = flag_country
         self.tonnage = tonnage
-        self.name = name
         self.length_overall = length_overall
-        self.id = vessel_id
 
 
 class FishingVessel(Vessel):
+    __slots__ = ('company', 'tonnage', 'length_overall')
+
     def __init__(self, metadata, flag_country, company, tonnage, name, length_overall, vessel_id):
         super(FishingVessel, self).__init__(EntityType.Vessel_FishingVessel, metadata, flag_country, name, vessel_id)
-        self.flag_country = flag_country
         self.company = company
         self.tonnage = tonnage
-        self.name = name
         self.length_overall = length_overall
-        self.id = vessel_id
 
 
 class OtherVessel(Vessel):
+    __slots__ = ('length_overall',)
+
     def __init__(self, metadata, flag_country, name, length_overall, vessel_id):
         super(OtherVessel, self).__init__(EntityType.Vessel_Other, metadata, flag_country, name, vessel_id)
-        self.flag_country = flag_country
-        self.name = name
         self.length_overall = length_overall
-        self.id = vessel_id
 
 
 class FerryPassengerVessel(Vessel):
+    __slots__ = ()
+
     def __init__(self, metadata, flag_country, name, vessel_id):
         super(FerryPassengerVessel, self).__init__(EntityType.Vessel_Ferry_Passenger, metadata, flag_country, name, vessel_id)
-        self.flag_country = flag_country
-        self.name = name
-        self.id = vessel_id
 
 
 class FerryCargoVessel(Vessel):
+    __slots__ = ()
+
     def __init__(self, metadata, flag_country, name, vessel_id):
         super(FerryCargoVessel, self).__init__(EntityType.Vessel_Ferry_Cargo, metadata, flag_country, name, vessel_id)
-        self.flag_country = flag_country
-        self.name = name
-        self.id = vessel_id
 
 
 class ResearchVessel(Vessel):
+    __slots__ = ()
+
     def __init__(self, metadata, flag_country, name, vessel_id):
         super(ResearchVessel, self).__init__(EntityType.Vessel_Research, metadata, flag_country, name, vessel_id)
-        self.flag_country = flag_country
-        self.name = name
-        self.id = vessel_id
 
 
 class TourVessel(Vessel):
+    __slots__ = ()
+
     def __init__(self, metadata, flag_country, name, vessel_id):
         super(TourVessel, self).__init__(EntityType.Vessel_Tour, metadata, flag_country, name, vessel_id)
-        self.flag_country = flag_country
-        self.name = name
-        self.id = vessel_id
 
 
 class Fish(Entity):
+    __slots__ = ('name', 'id')
+
     def __init__(self, metadata, name, fish_id):
         super(Fish, self).__init__(EntityType.Commodity_Fish, metadata)
         self.name = name
@@ -86,6 +92,8 @@ class Fish(Entity):
 
 
 class Location(Entity):
+    __slots__ = ('name', 'description', 'activity_list', 'kind', 'id')
+
     def __init__(self, location_type, metadata, name, description, activity_list, kind, location_id):
         super(Location, self).__init__(location_type, metadata)
         self.name = name
@@ -96,17 +104,23 @@ class Location(Entity):
 
 
 class Point(Location):
+    __slots__ = ()
+
     def __init__(self, metadata, name, description, activity_list, kind, point_id):
         super(Point, self).__init__(EntityType.Location_Point, metadata, name, description, activity_list, kind,
                                     point_id)
 
 
 class City(Location):
+    __slots__ = ()
+
     def __init__(self, metadata, name, description, activity_list, kind, city_id):
         super(City, self).__init__(EntityType.Location_City, metadata, name, description, activity_list, kind, city_id)
 
 
 class Region(Location):
+    __slots__ = ('fish_species_present',)
+
     def __init__(self, metadata, name, description, fish_species_present, activity_list, kind, region_id):
         super(Region, self).__init__(EntityType.Location_Region, metadata, name, description, activity_list, kind,
                                      region_id)
@@ -114,8 +128,10 @@ class Region(Location):
 
 
 class DeliveryReport(Entity):
+    __slots__ = ('qty_tons', 'date', 'id')
+
     def __init__(self, metadata, qty_tons, date, report_id):
-        super(DeliveryReport, self).__init__(EntityType.Location_Region, metadata)
+        super(DeliveryReport, self).__init__(EntityType.Document_DeliveryReport, metadata)
         self.qty_tons = qty_tons
         self.date = date
         self.id = report_id
@@ -123,7 +139,7 @@ class DeliveryReport(Entity):
 
 def parse_node(json_node):
     node_type = parse_type(json_node['type'])
-    metadata = parse_metadata(json_node)
+    metadata = metadata_fields(json_node)
     name = json_node.get('Name', None)
     description = json_node.get('Description', None)
     activity_list = json_node.get('Activities', None)
@@ -161,7 +177,7 @@ def parse_node(json_node):
     elif node_type == EntityType.Vessel_Other:
         return OtherVessel(metadata, flag_country, name, length_overall, id_)
     elif node_type == EntityType.Document_DeliveryReport:
-        date = parser.parse(date)
+        date = parse_datetime(date)
         return DeliveryReport(metadata, qty_tons, date, id_)
     else:
         raise 'Error parsing node'
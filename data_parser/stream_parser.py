@@ -0,0 +1,115 @@
+import json
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_NUMBER_START = '-0123456789'
+_NUMBER_CHARS = '0123456789+-.eE'
+
+
+class _StreamReader:
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # 丢掉已经解析过的部分, 缓冲区只保留未消费的文本
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON stream')
+
+    def take(self):
+        ch = self.peek()
+        self.pos += 1
+        return ch
+
+    def expect(self, ch):
+        if self.take() != ch:
+            raise ValueError('Expected %r at offset %d of the JSON buffer' % (ch, self.pos - 1))
+
+    def value(self):
+        number = self.peek() in _NUMBER_START
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+                # 数字可能恰好被缓冲区截断 (比如 "10." 只解析出 10), 后面跟着的不是数字的一部分才算解析完整
+                if self.eof or (end < len(self.buf) and not (number and self.buf[end] in _NUMBER_CHARS)):
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_json_arrays(file_path, keys, chunk_size=1 << 20):
+    """
+    Iterates over the elements of the top-level arrays named in keys without loading the whole file.
+
+    Only one chunk of raw text and the element being decoded are held in memory. Other top-level values are
+    decoded and dropped.
+
+    Args:
+        file_path (str): Path of a JSON file whose root is an object.
+        keys (tuple): Top-level keys whose array elements should be yielded.
+        chunk_size (int): Number of characters read from the file at a time.
+
+    Yields:
+        (key, element) pairs in file order.
+    """
+    with open(file_path, 'r') as f:
+        reader = _StreamReader(f, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key in keys and reader.peek() == '[':
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.take()
+                else:
+                    while True:
+                        yield key, reader.value()
+                        ch = reader.take()
+                        if ch == ']':
+                            break
+                        if ch != ',':
+                            raise ValueError('Malformed array %r in %s' % (key, file_path))
+            else:
+                reader.value()
+            ch = reader.take()
+            if ch == '}':
+                return
+            if ch != ',':
+                raise ValueError('Malformed JSON object in %s' % file_path)
+
+
+def iter_json_batches(file_path, keys, batch_size, chunk_size=1 << 20):
+    """Groups the output of iter_json_arrays into (key, list) batches of at most batch_size elements."""
+    batch_key = None
+    batch = []
+    for key, element in iter_json_arrays(file_path, keys, chunk_size):
+        if batch and (key != batch_key or len(batch) >= batch_size):
+            yield batch_key, batch
+            batch = []
+        batch_key = key
+        batch.append(element)
+    if batch:
+        yield batch_key, batch
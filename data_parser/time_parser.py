@@ -0,0 +1,28 @@
+import re
+from datetime import datetime
+
+import numpy as np
+from dateutil import parser
+
+# 数据集中的时间都是固定的 ISO 8601 格式, 例如 2035-09-16T04:06:48.185987 或 2035-02-01
+_ISO_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?)?$')
+
+
+def parse_datetime(value):
+    """Parses one timestamp, using datetime.fromisoformat for the dataset's ISO formats and dateutil otherwise."""
+    if _ISO_PATTERN.match(value):
+        return datetime.fromisoformat(value)
+    return parser.parse(value)
+
+
+def parse_datetime_array(values):
+    """
+    Converts a sequence of timestamp strings into a datetime64[us] array.
+
+    The whole batch is first handed to NumPy's ISO parser. If any string is not plain ISO 8601 the batch is
+    parsed one value at a time with parse_datetime. None becomes NaT.
+    """
+    try:
+        return np.array(values, dtype='datetime64[us]')
+    except ValueError:
+        return np.array([None if v is None else parse_datetime(v) for v in values], dtype='datetime64[us]')
@@ -0,0 +1,137 @@
+"""
+Nearest-neighbour search over the vessel embeddings learned by model.ShipRoutePredictor.
+
+EmbeddingIndex keeps one L2-normalized float32 row per vessel, so cosine similarity is a single matrix-vector
+product, and returns the top k rows with np.argpartition instead of sorting the whole fleet. It is built once from
+a trained model and saved as an .npz file that the server loads without torch.
+
+For large fleets the approximate mode searches an inverted file: the rows are clustered with spherical k-means,
+and a query only scores the rows of the `probes` clusters whose centroids are closest to it. The clusters are
+built on first use, or by build_clusters before save so they are stored with the index.
+"""
+import threading
+
+import numpy as np
+
+
+def _normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def _top_k(scores, k):
+    # 先用 argpartition 找出前 k 个, 只对这 k 个排序
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+class EmbeddingIndex:
+    """
+    Args:
+        ids: vessel id of every row
+        vectors: len(ids) x dim embeddings, normalized on construction
+    """
+
+    def __init__(self, ids, vectors, centroids=None, assignment=None):
+        self.ids = list(ids)
+        self.vectors = _normalized(vectors)
+        self.row = {vessel_id: i for i, vessel_id in enumerate(self.ids)}
+        if len(self.row) != len(self.ids):
+            raise ValueError('Duplicate vessel ids in embedding index')
+        self._clusters = None
+        if centroids is not None:
+            self._clusters = self._cluster_lists(np.asarray(centroids, dtype=np.float32), np.asarray(assignment))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_model(cls, model, ship_mapping):
+        """
+        Args:
+            model: trained ShipRoutePredictor, on any device
+            ship_mapping: vessel id -> ship embedding row, as used in training
+        """
+        weight = model.ship_id_embedding.weight.detach().cpu().numpy()
+        ids = list(ship_mapping)
+        return cls(ids, weight[[ship_mapping[vessel_id] for vessel_id in ids]])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            centroids = data['centroids'] if 'centroids' in data else None
+            assignment = data['assignment'] if 'assignment' in data else None
+            return cls(data['ids'].tolist(), data['vectors'], centroids, assignment)
+
+    def save(self, path):
+        arrays = {'ids': np.array(self.ids, dtype=np.str_), 'vectors': self.vectors}
+        if self._clusters is not None:
+            centroids, assignment, _, _ = self._clusters
+            arrays.update(centroids=centroids, assignment=assignment)
+        np.savez(path, **arrays)
+
+    def _cluster_lists(self, centroids, assignment):
+        # 按簇排序后的行号和每个簇的起点, 查询时直接切片
+        order = np.argsort(assignment, kind='stable')
+        starts = np.searchsorted(assignment[order], np.arange(len(centroids) + 1))
+        return centroids, assignment, order, starts
+
+    def build_clusters(self, num_clusters=None, iterations=10, seed=0):
+        """Spherical k-means over the rows, num_clusters defaults to about sqrt(len(self))."""
+        n = len(self.ids)
+        if num_clusters is None:
+            num_clusters = max(1, int(round(np.sqrt(n))))
+        num_clusters = min(num_clusters, n)
+        rng = np.random.default_rng(seed)
+        centroids = self.vectors[rng.choice(n, num_clusters, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(self.vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, self.vectors)
+            # 空簇保留原来的中心
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = _normalized(sums)
+        assignment = np.argmax(self.vectors @ centroids.T, axis=1)
+        self._clusters = self._cluster_lists(centroids, assignment)
+
+    def search(self, vector, k=10, approximate=False, probes=8, exclude=()):
+        """
+        Args:
+            vector: query embedding, normalized here
+            k: number of results
+            approximate: only score the rows of the `probes` clusters nearest to the query
+            exclude: vessel ids left out of the result
+
+        Returns:
+            list of (vessel id, cosine similarity), most similar first
+        """
+        if k < 1:
+            raise ValueError('k must be at least 1')
+        query = _normalized(vector)
+        if approximate:
+            if self._clusters is None:
+                with self._lock:
+                    if self._clusters is None:
+                        self.build_clusters()
+            centroids, _, order, starts = self._clusters
+            nearest = _top_k(centroids @ query, probes)
+            rows = np.concatenate([order[starts[c]:starts[c + 1]] for c in nearest])
+        else:
+            rows = np.arange(len(self.ids))
+        scores = self.vectors[rows] @ query
+        excluded = [self.row[vessel_id] for vessel_id in exclude if vessel_id in self.row]
+        if excluded:
+            keep = ~np.isin(rows, excluded)
+            rows, scores = rows[keep], scores[keep]
+        top = _top_k(scores, k)
+        return [(self.ids[rows[i]], float(scores[i])) for i in top]
+
+    def most_similar(self, vessel_id, k=10, approximate=False, probes=8):
+        """The k vessels most similar to vessel_id, itself excluded; raises KeyError for unknown vessels."""
+        return self.search(self.vectors[self.row[vessel_id]], k, approximate, probes, exclude=(vessel_id,))
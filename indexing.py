@@ -0,0 +1,160 @@
+import copy
+
+import numpy as np
+
+
+class Predicate:
+    """
+    Structured predicate on one attribute value.
+
+    Predicates are callable, so they can be passed anywhere a plain func is accepted (for example
+    service.select_edge_attribute). Called with a NumPy array they evaluate element-wise and return a boolean mask.
+    """
+
+    def __call__(self, value):
+        raise NotImplementedError
+
+
+class Eq(Predicate):
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, value):
+        return value == self.value
+
+    def __repr__(self):
+        return 'Eq(%r)' % (self.value,)
+
+
+class In(Predicate):
+    def __init__(self, values):
+        self.values = set(values)
+
+    def __call__(self, value):
+        if isinstance(value, np.ndarray):
+            return np.fromiter((v in self.values for v in value.tolist()), dtype=bool, count=len(value))
+        return value in self.values
+
+    def __repr__(self):
+        return 'In(%r)' % (self.values,)
+
+
+class Between(Predicate):
+    """low <= value <= high, either bound may be None."""
+
+    def __init__(self, low=None, high=None):
+        self.low = low
+        self.high = high
+
+    def __call__(self, value):
+        if isinstance(value, np.ndarray):
+            mask = np.ones(len(value), dtype=bool)
+            if self.low is not None:
+                mask &= value >= self.low
+            if self.high is not None:
+                mask &= value <= self.high
+            return mask
+        if value is None:
+            return False
+        return (self.low is None or self.low <= value) and (self.high is None or value <= self.high)
+
+    def __repr__(self):
+        return 'Between(%r, %r)' % (self.low, self.high)
+
+
+def _positions(positions):
+    # 查询结果按存储顺序返回, 与全表扫描的结果顺序一致
+    return np.sort(np.asarray(positions, dtype=np.int64))
+
+
+class HashIndex:
+    """Equality index: value -> positions. Answers Eq and In."""
+
+    kind = 'hash'
+
+    def __init__(self, values):
+        buckets = {}
+        for position, value in enumerate(values):
+            buckets.setdefault(value, []).append(position)
+        self.buckets = {value: np.array(positions, dtype=np.int64) for value, positions in buckets.items()}
+
+    def appended(self, values, start):
+        """Returns a new index that also covers values at positions start, start + 1, ..."""
+        index = copy.copy(self)
+        index.buckets = dict(self.buckets)
+        added = {}
+        for position, value in enumerate(values, start):
+            added.setdefault(value, []).append(position)
+        for value, positions in added.items():
+            old = index.buckets.get(value)
+            positions = np.array(positions, dtype=np.int64)
+            index.buckets[value] = positions if old is None else np.concatenate([old, positions])
+        return index
+
+    def supports(self, predicate):
+        return isinstance(predicate, (Eq, In))
+
+    def lookup(self, predicate):
+        empty = np.empty(0, dtype=np.int64)
+        if isinstance(predicate, Eq):
+            return self.buckets.get(predicate.value, empty)
+        return _positions(np.concatenate([self.buckets.get(v, empty) for v in predicate.values] + [empty]))
+
+
+class SortedIndex:
+    """Range index: positions ordered by value. Answers Between and Eq with binary searches."""
+
+    kind = 'sorted'
+
+    def __init__(self, values):
+        self.order, self.sorted_values = self._sort(values)
+
+    @staticmethod
+    def _sort(values):
+        values = values if isinstance(values, np.ndarray) else np.array(values, dtype=object)
+        if values.dtype == object:
+            # None 无法参与排序, 也不会被任何范围查询命中
+            present = np.fromiter((v is not None for v in values), dtype=bool, count=len(values))
+        elif np.issubdtype(values.dtype, np.datetime64):
+            present = ~np.isnat(values)
+        elif np.issubdtype(values.dtype, np.floating):
+            present = ~np.isnan(values)
+        else:
+            present = np.ones(len(values), dtype=bool)
+        positions = np.flatnonzero(present)
+        order = positions[np.argsort(values[positions], kind='stable')]
+        return order, values[order]
+
+    def appended(self, values, start):
+        """Returns a new index that also covers values at positions start, start + 1, ... merged into the order."""
+        order, sorted_values = self._sort(values)
+        index = copy.copy(self)
+        # 相同的值新位置排在旧位置之后, 与整体稳定排序的结果一致
+        insert_at = np.searchsorted(self.sorted_values, sorted_values, side='right')
+        index.order = np.insert(self.order, insert_at, order + start)
+        index.sorted_values = np.insert(self.sorted_values, insert_at, sorted_values)
+        return index
+
+    def supports(self, predicate):
+        return isinstance(predicate, (Between, Eq))
+
+    def _bound(self, value):
+        if np.issubdtype(self.sorted_values.dtype, np.datetime64):
+            return np.datetime64(value, 'us')
+        return value
+
+    def lookup(self, predicate):
+        if isinstance(predicate, Eq):
+            low, high = predicate.value, predicate.value
+        else:
+            low, high = predicate.low, predicate.high
+        lo = 0 if low is None else np.searchsorted(self.sorted_values, self._bound(low), side='left')
+        hi = len(self.sorted_values) if high is None else np.searchsorted(self.sorted_values, self._bound(high),
+                                                                          side='right')
+        return _positions(self.order[lo:max(lo, hi)])
+
+
+INDEX_KINDS = {
+    HashIndex.kind: HashIndex,
+    SortedIndex.kind: SortedIndex,
+}
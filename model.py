@@ -1,18 +1,36 @@
 import datetime
+import os
 import time
 
 import matplotlib.pyplot as plt
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from sklearn.metrics.pairwise import cosine_similarity
 from tqdm import tqdm
 
 import service
+from embedding_index import EmbeddingIndex
 
 import datetime
 
+# 训练设备, None 表示有 GPU 时用 GPU, 否则用 CPU
+DEVICE = None
+# CPU 训练的算子内线程数, None 表示使用全部核心
+NUM_THREADS = None
+
+
+def resolve_device(device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def configure_cpu_threads(num_threads=None):
+    torch.set_num_threads(num_threads or os.cpu_count())
+
 
 def preprocess_data(transponderpings_dict, vocab_mapping, ship_mapping, time_interval, max_len):
     """
@@ -34,35 +52,118 @@ def preprocess_data(transponderpings_dict, vocab_mapping, ship_mapping, time_int
     ship_ids = []
 
     for vessel_id, pings in transponderpings_dict.items():
-        # Sort by time
-        pings = sorted(pings, key=lambda x: x['time'])
-        start_time = pings[0]['time']
-        current_time = start_time
-
-        # Generate a sequence of regions based on dwell times and time intervals
-        seq = []
-        seq.append(vocab_mapping[pings[0]['source']])
-
-        for ping in pings:
-            source = ping['source']
-            dwell = ping['dwell']
-            ping_time = ping['time']
-            dwell_duration = datetime.timedelta(seconds=dwell)
-            time_slots = (ping_time + dwell_duration - current_time).seconds // time_interval
-            if time_slots != 0:
-                seq.extend([vocab_mapping[source]] * time_slots)
-                current_time += datetime.timedelta(seconds=time_slots * time_interval)
-
-        # Split the long sequence into smaller sequences if it's too long
-        for i in range(0, len(seq) - 1, max_len):
-            input_seq = seq[i:i + max_len - 1]  # All except the last token
-            target_seq = seq[i + 1:i + max_len]  # All except the first token
-
-            # Only append if the sequence is long enough to have both input and target
-            if len(input_seq) > 0 and len(target_seq) > 0:
-                sequences.append(input_seq)
-                labels.append(target_seq)
-                ship_ids.append(ship_mapping[vessel_id])
+        # 没有 ping 的船没有序列
+        if not pings:
+            continue
+        seq = _route_sequence(pings, vocab_mapping, time_interval)
+        _split_sequence(seq, max_len, ship_mapping[vessel_id], sequences, labels, ship_ids)
+
+    return sequences, labels, ship_ids
+
+
+def _route_sequence(pings, vocab_mapping, time_interval):
+    # Sort by time
+    pings = sorted(pings, key=lambda x: x['time'])
+    start_time = pings[0]['time']
+    current_time = start_time
+
+    # Generate a sequence of regions based on dwell times and time intervals
+    seq = []
+    seq.append(vocab_mapping[pings[0]['source']])
+
+    for ping in pings:
+        source = ping['source']
+        dwell = ping['dwell']
+        ping_time = ping['time']
+        dwell_duration = datetime.timedelta(seconds=dwell)
+        time_slots = (ping_time + dwell_duration - current_time).seconds // time_interval
+        if time_slots != 0:
+            seq.extend([vocab_mapping[source]] * time_slots)
+            current_time += datetime.timedelta(seconds=time_slots * time_interval)
+    return seq
+
+
+def _split_sequence(seq, max_len, ship_id, sequences, labels, ship_ids):
+    # Split the long sequence into smaller sequences if it's too long
+    for i in range(0, len(seq) - 1, max_len):
+        input_seq = seq[i:i + max_len - 1]  # All except the last token
+        target_seq = seq[i + 1:i + max_len]  # All except the first token
+
+        # Only append if the sequence is long enough to have both input and target
+        if len(input_seq) > 0 and len(target_seq) > 0:
+            sequences.append(input_seq)
+            labels.append(target_seq)
+            ship_ids.append(ship_id)
+
+
+def _dwell_microseconds(dwell):
+    # 与 datetime.timedelta(seconds=dwell) 相同: 整数秒加上小数部分按四舍六入五成双取整到微秒
+    whole = np.trunc(dwell)
+    return whole.astype(np.int64) * 1000000 + np.round((dwell - whole) * 1e6).astype(np.int64)
+
+
+def _slot_counts(elapsed, time_interval):
+    """
+    Number of time slots preprocess_data adds for each ping, without the per-ping loop.
+
+    elapsed[k] is ping time + dwell - first ping time in microseconds. preprocess_data keeps current_time on the grid
+    start_time + m * time_interval and adds ((end_k - current_time).seconds // time_interval) slots, where .seconds
+    drops whole days. When time_interval divides a day that is (G_k - m_k) mod D with G_k = elapsed[k] // interval
+    and D slots per day, so m_{k+1} = G_k + D * j_{k+1} with j_{k+1} = j_k + ceil((G_{k-1} - G_k) / D), a cumulative
+    sum (G_{-1} = m_0 = j_0 = 0).
+    """
+    day_slots = 86400 // time_interval
+    grid = elapsed // (time_interval * 1000000)
+    previous = np.concatenate([[0], grid[:-1]])
+    j = np.cumsum(-((grid - previous) // day_slots))
+    return np.diff(grid + day_slots * j, prepend=0)
+
+
+def preprocess_arrays(ping_arrays, location_ids, vocab_mapping, ship_mapping, time_interval, max_len):
+    """
+    Same output as preprocess_data, built from per-vessel arrays with NumPy instead of one ping dict at a time.
+
+    Slot counts come from _slot_counts and token sequences from np.repeat; the input/label windows are views into
+    one token array per vessel. Vessels with a non-finite dwell, or a time_interval that does not divide a day, go
+    through the preprocess_data loop.
+
+    Args:
+        ping_arrays (dict): Vessel id -> (time, dwell, source code) arrays sorted by time, as returned by
+            service.select_transponder_ping_arrays.
+        location_ids (list): Location id of every source code.
+        vocab_mapping (dict): Mapping of source regions to unique tokens.
+        ship_mapping (dict): Vessel id -> ship id.
+        time_interval (int): Time interval for discretizing timestamps, in seconds.
+        max_len (int): Maximum sequence length for splitting.
+
+    Returns:
+        sequences, labels, ship_ids as in preprocess_data, with sequences and labels as int64 arrays.
+    """
+    sequences = []
+    labels = []
+    ship_ids = []
+    tokens = np.array([vocab_mapping.get(location, -1) for location in location_ids], dtype=np.int64)
+    vectorized = isinstance(time_interval, (int, np.integer)) and 86400 % time_interval == 0
+
+    for vessel_id, (times, dwell, sources) in ping_arrays.items():
+        if len(times) == 0:
+            continue
+        if not vectorized or not np.all(np.isfinite(dwell)):
+            pings = [{'time': t, 'dwell': d, 'source': location_ids[c]}
+                     for t, d, c in zip(times.tolist(), dwell.tolist(), sources.tolist())]
+            seq = np.array(_route_sequence(pings, vocab_mapping, time_interval), dtype=np.int64)
+        else:
+            elapsed = (times - times[0]).astype(np.int64) + _dwell_microseconds(dwell)
+            counts = _slot_counts(elapsed, time_interval)
+            vessel_tokens = tokens[sources]
+            # 和 preprocess_data 一样, 只有用到的地点才需要在 vocab_mapping 里
+            used = counts > 0
+            used[0] = True
+            missing = used & (vessel_tokens < 0)
+            if missing.any():
+                raise KeyError(location_ids[sources[np.argmax(missing)]])
+            seq = np.concatenate([vessel_tokens[:1], np.repeat(vessel_tokens, counts)])
+        _split_sequence(seq, max_len, ship_mapping[vessel_id], sequences, labels, ship_ids)
 
     return sequences, labels, ship_ids
 
@@ -78,25 +179,103 @@ def collate_fn(batch):
     sequence_lengths = torch.tensor([len(seq) for seq in sequences])  # 获取每个序列的长度
     mask = torch.arange(sequences_padded.size(1)).unsqueeze(0) < sequence_lengths.unsqueeze(1)
 
-    ship_ids = torch.tensor(ship_ids, dtype=torch.long, device='cuda')
+    ship_ids = torch.tensor(ship_ids, dtype=torch.long)
+
+    # 批次留在 CPU 上, 由 train_model 移到模型所在的设备
+    return sequences_padded, labels_padded, ship_ids, mask
+
 
-    return sequences_padded, labels_padded, ship_ids, mask.cuda()
+def _pack(sequences):
+    lengths = torch.tensor([len(seq) for seq in sequences], dtype=torch.long)
+    offsets = torch.zeros(len(sequences) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(lengths, 0)
+    # 序列可以是 list 或 preprocess_arrays 返回的数组
+    buffer = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in sequences] + [np.empty(0, dtype=np.int64)])
+    return torch.from_numpy(buffer), offsets, lengths
 
 
 class ShipRouteDataset(Dataset):
+    """
+    Sequences and labels tensorized once into packed token buffers with per-sequence offsets.
+
+    dataset[i] returns (sequence, labels, ship_id) as views into the buffers, for DataLoader with collate_fn.
+    dataset[list of indices] returns a whole padded batch (sequences, labels, ship_ids, mask) gathered with one
+    indexing operation per buffer, which is how make_dataloader loads LengthBucketSampler batches. Labels are padded
+    to the width of the sequences.
+    """
+
     def __init__(self, sequences, labels, ship_ids, vocab_size):
-        self.sequences = sequences
-        self.labels = labels
-        self.ship_ids = ship_ids  # Now also receive ship_ids
+        self.tokens, self.offsets, self.lengths = _pack(sequences)
+        self.targets, self.label_offsets, self.label_lengths = _pack(labels)
+        self.ship_ids = torch.tensor(ship_ids, dtype=torch.long)
         self.vocab_size = vocab_size
 
     def __len__(self):
-        return len(self.sequences)
+        return len(self.lengths)
+
+    @staticmethod
+    def _padded(buffer, offsets, lengths, width):
+        steps = torch.arange(width)
+        mask = steps.unsqueeze(0) < lengths.unsqueeze(1)
+        positions = (offsets.unsqueeze(1) + steps).clamp_(max=max(len(buffer) - 1, 0))
+        return buffer[positions].masked_fill_(~mask, 0), mask
 
     def __getitem__(self, idx):
-        return torch.tensor(self.sequences[idx], dtype=torch.long, device='cuda'), \
-               torch.tensor(self.labels[idx], dtype=torch.long, device='cuda'), \
-               torch.tensor(self.ship_ids[idx], dtype=torch.long, device='cuda')  # Return the ship ID
+        if not isinstance(idx, (list, tuple, torch.Tensor)):
+            return self.tokens[self.offsets[idx]:self.offsets[idx + 1]], \
+                   self.targets[self.label_offsets[idx]:self.label_offsets[idx + 1]], \
+                   self.ship_ids[idx]
+
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        width = int(self.lengths[idx].max())
+        sequences, mask = self._padded(self.tokens, self.offsets[idx], self.lengths[idx], width)
+        labels, _ = self._padded(self.targets, self.label_offsets[idx], self.label_lengths[idx], width)
+        return sequences, labels, self.ship_ids[idx], mask
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Yields batches of dataset indices with similar sequence lengths, to cut padding.
+
+    Indices are shuffled and cut into pools of batch_size * pool_batches; each pool is sorted by length and cut into
+    batches, and the order of all batches is shuffled again.
+    """
+
+    def __init__(self, lengths, batch_size, pool_batches=50, shuffle=True, generator=None):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.pool_size = batch_size * pool_batches
+        self.shuffle = shuffle
+        self.generator = generator
+
+    def __len__(self):
+        n = len(self.lengths)
+        full, rest = divmod(n, self.pool_size)
+        return full * -(-self.pool_size // self.batch_size) + -(-rest // self.batch_size)
+
+    def __iter__(self):
+        n = len(self.lengths)
+        order = torch.randperm(n, generator=self.generator) if self.shuffle else torch.arange(n)
+        batches = []
+        for start in range(0, n, self.pool_size):
+            pool = order[start:start + self.pool_size]
+            pool = pool[torch.sort(self.lengths[pool], stable=True).indices]
+            batches.extend(pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=self.generator).tolist()]
+        return iter(batches)
+
+
+def make_dataloader(dataset, batch_size=64, shuffle=True, bucket_by_length=True, pool_batches=50, device=None):
+    """
+    DataLoader over a ShipRouteDataset. With bucket_by_length, batches come from LengthBucketSampler and are gathered
+    from the packed buffers in one step; otherwise samples are drawn one by one and padded by collate_fn.
+    """
+    pin_memory = resolve_device(device).type == 'cuda'
+    if bucket_by_length:
+        sampler = LengthBucketSampler(dataset.lengths, batch_size, pool_batches, shuffle)
+        return DataLoader(dataset, sampler=sampler, batch_size=None, pin_memory=pin_memory)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn, pin_memory=pin_memory)
 
 
 # 3. Transformer Model
@@ -123,12 +302,15 @@ class ShipRoutePredictor(nn.Module):
         return out
 
 
-def train_model(model, dataloader, criterion, optimizer, scheduler, epochs=10):
+def train_model(model, dataloader, criterion, optimizer, scheduler, epochs=10, plot=True):
+    # 批次移到模型参数所在的设备
+    device = next(model.parameters()).device
     model.train()
     loss_list = []
     for epoch in range(epochs):
         epoch_loss = 0
-        for sequences, targets, ship_ids, mask in tqdm(dataloader):
+        for batch in tqdm(dataloader):
+            sequences, targets, ship_ids, mask = (t.to(device, non_blocking=True) for t in batch)
             optimizer.zero_grad()
             outputs = model(sequences, ship_ids)  # (batch_size, seq_len, vocab_size)
 
@@ -149,42 +331,51 @@ def train_model(model, dataloader, criterion, optimizer, scheduler, epochs=10):
         loss_list.append(epoch_loss / len(dataloader))
         print(f"Epoch {epoch + 1}/{epochs}, Loss: {epoch_loss / len(dataloader):.4f}", flush=True)
 
+    if not plot:
+        return loss_list
     plt.plot(range(1, epochs + 1), loss_list)
     plt.title('Train Loss')
     plt.xlabel('Epochs')
     plt.ylabel('Loss')
     plt.legend()
     plt.show()
+    return loss_list
 
 
 # 5. Similarity Calculation
 def calculate_similarity(model, ship_sequences, ship_ids):
     model.eval()
+    device = model.ship_id_embedding.weight.device
     embeddings = []
     with torch.no_grad():
         for seq, ship_id in zip(ship_sequences, ship_ids):
-            seq = torch.tensor(seq, dtype=torch.long).unsqueeze(0)
-            ship_id = torch.tensor([ship_id], dtype=torch.long)
+            seq = torch.tensor(seq, dtype=torch.long, device=device).unsqueeze(0)
+            ship_id = torch.tensor([ship_id], dtype=torch.long, device=device)
             embedding = model.embedding(seq) + model.ship_id_embedding(ship_id).unsqueeze(1)
             embeddings.append(embedding.mean(dim=1).squeeze(0))
-    embeddings = torch.stack(embeddings).numpy()
+    embeddings = torch.stack(embeddings).cpu().numpy()
     return cosine_similarity(embeddings)
 
 
 def calculate_similarity_static(model, ship_ids):
     model.eval()
     with torch.no_grad():
-        embeddings = model.ship_id_embedding(torch.tensor(ship_ids, dtype=torch.long).cuda())
+        weight = model.ship_id_embedding.weight
+        embeddings = model.ship_id_embedding(torch.tensor(ship_ids, dtype=torch.long, device=weight.device))
     return cosine_similarity(embeddings.cpu().numpy())
 
 
 def get_ship_embedding(model, ship_ids):
     model.eval()
     with torch.no_grad():
-        return model.ship_id_embedding(torch.tensor(ship_ids, dtype=torch.long))
+        weight = model.ship_id_embedding.weight
+        return model.ship_id_embedding(torch.tensor(ship_ids, dtype=torch.long, device=weight.device))
 
 
 if __name__ == "__main__":
+    device = resolve_device(DEVICE)
+    if device.type == 'cpu':
+        configure_cpu_threads(NUM_THREADS)
     t1 = time.time()
     service.initialize('./data/MC2/mc2.json', geo_file_path='./data/MC2/Oceanus Information/Oceanus Geography.geojson')
     t2 = time.time()
@@ -193,11 +384,11 @@ if __name__ == "__main__":
     vocab_mapping = {k: v + 1 for v, k in enumerate(service.id2location.keys())}
     ship_mapping = {k: v for v, k in enumerate(service.id2vessel.keys())}
 
-    transponderpings_dict = service.select_transponder_ping()
+    ping_arrays, location_ids = service.select_transponder_ping_arrays()
 
     time_interval = 3600
-    sequences, labels, ship_ids = preprocess_data(transponderpings_dict, vocab_mapping, ship_mapping, time_interval,
-                                                  max_len=128)
+    sequences, labels, ship_ids = preprocess_arrays(ping_arrays, location_ids, vocab_mapping, ship_mapping,
+                                                    time_interval, max_len=128)
     max_length = 0
     for s in sequences:
         if (len(s) > max_length):
@@ -208,15 +399,15 @@ if __name__ == "__main__":
     embed_dim = 64
     num_heads = 4
     num_layers = 2
-    num_ships = len(transponderpings_dict.keys())
+    num_ships = len(ping_arrays)
     dropout = 0.1
 
     dataset = ShipRouteDataset(sequences, labels, ship_ids, vocab_size)
-    dataloader = DataLoader(dataset, batch_size=64, shuffle=True, collate_fn=collate_fn)
+    dataloader = make_dataloader(dataset, batch_size=64, device=device)
 
     # Model, optimizer, and loss function
     model = ShipRoutePredictor(vocab_size=vocab_size, embed_dim=embed_dim, num_heads=num_heads, num_layers=num_layers,
-                               num_ships=num_ships, dropout=dropout, max_seq_len=max_length).cuda()
+                               num_ships=num_ships, dropout=dropout, max_seq_len=max_length).to(device)
     print(vocab_size, embed_dim, num_heads, num_layers, num_ships, dropout, max_length)
     criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=2e-3)
@@ -229,3 +420,5 @@ if __name__ == "__main__":
     train_model(model, dataloader, criterion, optimizer, scheduler, epochs=30)
 
     torch.save(model.state_dict(), 'model.pth')
+    # 服务端用来查找相似船只的嵌入索引, 不需要 torch; 没有 ping 的船没有参与训练, 不放进索引
+    EmbeddingIndex.from_model(model, {v: ship_mapping[v] for v in ping_arrays}).save('ship_embedding.npz')
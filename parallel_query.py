@@ -0,0 +1,121 @@
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from ping_table import Interner, PingTable
+
+# 进程池在服务的线程里按需启动, fork 可能复制其他线程持有的锁 (torch/OpenMP/BLAS) 导致死锁, 所以用 forkserver
+MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# 工作进程查询时需要的 PingTable 数组
+SHARED_FIELDS = ('time', 'dwell', 'source', 'target', 'vessel_order', 'vessel_offsets', 'vessel_time')
+
+# 工作进程内的只读数据, 由 _attach 在进程启动时设置
+_worker_table = None
+_worker_location_xy = None
+_worker_blocks = []
+
+
+def _share_array(array):
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach_array(spec):
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    _worker_blocks.append(block)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _attach(table_spec, location_xy_spec, location_ids):
+    global _worker_table, _worker_location_xy
+    table = PingTable()
+    for field, spec in table_spec.items():
+        setattr(table, field, _attach_array(spec))
+    table.locations = Interner(location_ids)
+    _worker_table = table
+    _worker_location_xy = _attach_array(location_xy_spec)
+
+
+def _vessel_paths(tasks):
+    return [_worker_table.vessel_path(code, start, end, _worker_location_xy) for code, start, end in tasks]
+
+
+def _vessel_dwells(tasks):
+    return [_worker_table.vessel_dwell(code, start, end, _worker_location_xy) for code, start, end in tasks]
+
+
+class ParallelQueryExecutor:
+    """
+    Runs per-vessel path and dwell extraction in a process pool.
+
+    The ping columns and indexes are copied once into shared memory when the executor is created, so a request
+    only sends (vessel code, start, end) tuples to the workers and gets the per-vessel results back. Queries over
+    at most serial_cutoff vessels are answered in the calling process.
+    """
+
+    def __init__(self, table, location_xy, num_workers=4, serial_cutoff=8):
+        self.table = table
+        self.location_xy = location_xy
+        self.num_workers = num_workers
+        self.serial_cutoff = serial_cutoff
+        self.blocks = []
+
+        table_spec = {}
+        for field in SHARED_FIELDS:
+            block, table_spec[field] = _share_array(getattr(table, field))
+            self.blocks.append(block)
+        block, location_xy_spec = _share_array(location_xy)
+        self.blocks.append(block)
+
+        self.executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=MP_CONTEXT, initializer=_attach,
+                                            initargs=(table_spec, location_xy_spec,
+                                                      list(table.locations.values)))
+
+    def _run(self, worker_func, serial_func, vessel_ids, start_time, end_time):
+        tasks = [(self.table.vessels.get(v), start_time, end_time) for v in vessel_ids]
+        if len(tasks) <= self.serial_cutoff:
+            return [serial_func(code, start, end, self.location_xy) for code, start, end in tasks]
+
+        # 每个工作进程分到一段连续的船, 结果按原顺序拼接
+        shard_size = math.ceil(len(tasks) / self.num_workers)
+        shards = [tasks[i:i + shard_size] for i in range(0, len(tasks), shard_size)]
+        results = []
+        for shard_result in self.executor.map(worker_func, shards):
+            results.extend(shard_result)
+        return results
+
+    def _iter(self, worker_func, serial_func, vessel_ids, start_time, end_time):
+        tasks = [(self.table.vessels.get(v), start_time, end_time) for v in vessel_ids]
+        if len(tasks) <= self.serial_cutoff:
+            for code, start, end in tasks:
+                yield serial_func(code, start, end, self.location_xy)
+            return
+        # 流式输出时每艘船单独提交, 第一艘船算完就可以返回
+        for shard_result in self.executor.map(worker_func, [[task] for task in tasks]):
+            yield shard_result[0]
+
+    def iter_vessel_paths(self, vessel_ids, start_time=None, end_time=None):
+        return self._iter(_vessel_paths, self.table.vessel_path, vessel_ids, start_time, end_time)
+
+    def iter_vessel_dwells(self, vessel_ids, start_time=None, end_time=None):
+        return self._iter(_vessel_dwells, self.table.vessel_dwell, vessel_ids, start_time, end_time)
+
+    def vessel_paths(self, vessel_ids, start_time=None, end_time=None):
+        return self._run(_vessel_paths, self.table.vessel_path, vessel_ids, start_time, end_time)
+
+    def vessel_dwells(self, vessel_ids, start_time=None, end_time=None):
+        return self._run(_vessel_dwells, self.table.vessel_dwell, vessel_ids, start_time, end_time)
+
+    def shutdown(self):
+        self.executor.shutdown()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
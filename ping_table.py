@@ -0,0 +1,333 @@
+import copy
+
+import numpy as np
+
+from data_parser.edge_parser import TransponderPing
+from data_parser.type_parser import EventType
+from data_parser.metadata_parser import Metadata, metadata_fields
+from data_parser.time_parser import parse_datetime_array
+from indexing import Predicate
+from simplify import simplify_path
+
+
+class Interner:
+    """Maps hashable values to dense int32 codes, in first-seen order."""
+
+    def __init__(self, values=()):
+        self.values = []
+        self.codes = {}
+        for value in values:
+            self.code(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, value):
+        return value in self.codes
+
+    def code(self, value):
+        c = self.codes.get(value)
+        if c is None:
+            c = len(self.values)
+            self.codes[value] = c
+            self.values.append(value)
+        return c
+
+    def get(self, value, default=-1):
+        return self.codes.get(value, default)
+
+    def encode(self, values):
+        return np.fromiter((self.code(v) for v in values), dtype=np.int32, count=len(values))
+
+    def copy(self):
+        other = Interner()
+        other.values = list(self.values)
+        other.codes = dict(self.codes)
+        return other
+
+    def lookup(self, values):
+        # 和 encode 不同, 不认识的值返回 -1 而不是新分配编码
+        return np.fromiter((self.codes.get(v, -1) for v in values), dtype=np.int32, count=len(values))
+
+
+def ping_columns(records):
+    """
+    Converts raw TransponderPing link records from mc2.json into plain columns that are cheap to pickle between
+    processes. Times are converted in one batch instead of one dateutil call per record.
+
+    The result is consumed by PingTable.extend.
+    """
+    return {
+        'time': parse_datetime_array([r.get('time', None) for r in records]),
+        'dwell': np.array([r.get('dwell', None) for r in records], dtype=np.float64),
+        'source': [r.get('source', None) for r in records],
+        'target': [r.get('target', None) for r in records],
+        'key': [r.get('key', None) for r in records],
+        'metadata': [metadata_fields(r) for r in records],
+    }
+
+
+def _time_window(sorted_times, start_time, end_time):
+    # [start_time, end_time] 在已排序时间数组中对应的下标区间
+    a = 0 if start_time is None else np.searchsorted(sorted_times, np.datetime64(start_time, 'us'), side='left')
+    b = len(sorted_times) if end_time is None else np.searchsorted(sorted_times, np.datetime64(end_time, 'us'),
+                                                                   side='right')
+    return int(a), int(max(a, b))
+
+
+class PingTable:
+    """
+    Column store for every TransponderPing edge.
+
+    Locations (ping sources), vessels (ping targets), keys and metadata are interned, so each ping costs one
+    datetime64, one float64 and four int32 values. TransponderPing objects are only built on demand by row/rows.
+    """
+
+    def __init__(self):
+        self.locations = Interner()
+        self.vessels = Interner()
+        self.keys = Interner()
+        self.metadata_values = Interner()
+
+        self.time = np.empty(0, dtype='datetime64[us]')
+        self.dwell = np.empty(0, dtype=np.float64)
+        self.source = np.empty(0, dtype=np.int32)
+        self.target = np.empty(0, dtype=np.int32)
+        self.key = np.empty(0, dtype=np.int32)
+        self.metadata = np.empty(0, dtype=np.int32)
+
+        # 按 (船, 时间) 排好序的行号, vessel_offsets[v]:vessel_offsets[v + 1] 是船 v 的区间
+        self.vessel_order = np.empty(0, dtype=np.int64)
+        self.vessel_offsets = np.zeros(1, dtype=np.int64)
+        self.vessel_time = np.empty(0, dtype='datetime64[us]')
+        # 按 (船, 地点, 时间) 排好序的行号, 以及每个 (船, 地点) 分组内的累计停留时间
+        # 每艘船的区间同样是 vessel_offsets[v]:vessel_offsets[v + 1]
+        self.dwell_order = np.empty(0, dtype=np.int64)
+        self.dwell_source = np.empty(0, dtype=np.int32)
+        self.dwell_time = np.empty(0, dtype='datetime64[us]')
+        self.dwell_cumsum = np.empty(0, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.time)
+
+    def extend(self, columns):
+        self.time = np.concatenate([self.time, columns['time']])
+        self.dwell = np.concatenate([self.dwell, columns['dwell']])
+        self.source = np.concatenate([self.source, self.locations.encode(columns['source'])])
+        self.target = np.concatenate([self.target, self.vessels.encode(columns['target'])])
+        self.key = np.concatenate([self.key, self.keys.encode(columns['key'])])
+        self.metadata = np.concatenate([self.metadata, self.metadata_values.encode(columns['metadata'])])
+
+    def build_index(self):
+        # lexsort 是稳定排序, 同一时间的 ping 保持原始顺序
+        self.vessel_order = np.lexsort((self.time, self.target))
+        self.vessel_offsets = np.searchsorted(self.target[self.vessel_order], np.arange(len(self.vessels) + 1))
+        self.vessel_time = self.time[self.vessel_order]
+
+        self.dwell_order = np.lexsort((self.time, self.source, self.target))
+        self.dwell_source = self.source[self.dwell_order]
+        self.dwell_time = self.time[self.dwell_order]
+        self.dwell_cumsum = np.empty(len(self), dtype=np.float64)
+        group_bounds = np.flatnonzero(np.diff(self.target[self.dwell_order]) | np.diff(self.dwell_source))
+        starts = np.concatenate([[0], group_bounds + 1])
+        ends = np.concatenate([group_bounds + 1, [len(self)]])
+        for lo, hi in zip(starts.tolist(), ends.tolist()):
+            self._group_cumsum(lo, hi)
+
+    def appended(self, columns):
+        """
+        Returns a new table with the rows of columns (see ping_columns) added after the existing ones.
+
+        The per-vessel and (vessel, location) orders are updated by inserting the new rows at their sorted positions
+        instead of sorting again, and only the prefix sums of the (vessel, location) groups that got new rows are
+        recomputed. self is not modified, so queries still reading it are unaffected.
+        """
+        table = copy.copy(self)
+        table.locations = self.locations.copy()
+        table.vessels = self.vessels.copy()
+        table.keys = self.keys.copy()
+        table.metadata_values = self.metadata_values.copy()
+        table.extend(columns)
+        table._merge_index(len(self))
+        return table
+
+    def _merge_index(self, start):
+        # start 之前的行已经建好索引, 把 start 之后的新行插入到排好序的位置
+        new_rows = np.arange(start, len(self))
+        if not len(new_rows):
+            return
+        old_offsets = self.vessel_offsets
+        old_vessels = len(old_offsets) - 1
+
+        def segment(vessel_code):
+            # 旧索引里船的区间, 新出现的船排在最后
+            if vessel_code < old_vessels:
+                return old_offsets[vessel_code], old_offsets[vessel_code + 1]
+            return start, start
+
+        rows = new_rows[np.lexsort((self.time[new_rows], self.target[new_rows]))]
+        targets = self.target[rows]
+        vessel_bounds = np.flatnonzero(np.diff(targets)) + 1
+        positions = []
+        for chunk in np.split(rows, vessel_bounds):
+            lo, hi = segment(self.target[chunk[0]])
+            positions.append(lo + np.searchsorted(self.vessel_time[lo:hi], self.time[chunk], side='right'))
+        positions = np.concatenate(positions)
+        self.vessel_order = np.insert(self.vessel_order, positions, rows)
+        self.vessel_time = np.insert(self.vessel_time, positions, self.time[rows])
+
+        rows = new_rows[np.lexsort((self.time[new_rows], self.source[new_rows], self.target[new_rows]))]
+        keys = np.stack([self.target[rows], self.source[rows]])
+        group_bounds = np.flatnonzero(np.any(np.diff(keys, axis=1) != 0, axis=0)) + 1
+        positions = []
+        groups = []
+        for chunk in np.split(rows, group_bounds):
+            vessel_code, location_code = self.target[chunk[0]], self.source[chunk[0]]
+            lo, hi = segment(vessel_code)
+            sources = self.dwell_source[lo:hi]
+            g_lo = lo + np.searchsorted(sources, location_code, side='left')
+            g_hi = lo + np.searchsorted(sources, location_code, side='right')
+            positions.append(g_lo + np.searchsorted(self.dwell_time[g_lo:g_hi], self.time[chunk], side='right'))
+            groups.append((vessel_code, location_code))
+        positions = np.concatenate(positions)
+        self.dwell_order = np.insert(self.dwell_order, positions, rows)
+        self.dwell_source = np.insert(self.dwell_source, positions, self.source[rows])
+        self.dwell_time = np.insert(self.dwell_time, positions, self.time[rows])
+        self.dwell_cumsum = np.insert(self.dwell_cumsum, positions, 0)
+
+        counts = np.diff(old_offsets)
+        counts = np.concatenate([counts, np.zeros(len(self.vessels) - old_vessels, dtype=counts.dtype)])
+        counts += np.bincount(self.target[new_rows], minlength=len(self.vessels))
+        self.vessel_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        for vessel_code, location_code in groups:
+            lo, hi = self._vessel_range(vessel_code)
+            sources = self.dwell_source[lo:hi]
+            self._group_cumsum(lo + np.searchsorted(sources, location_code, side='left'),
+                               lo + np.searchsorted(sources, location_code, side='right'))
+
+    def _group_cumsum(self, lo, hi):
+        # nan 的停留时间按 0 计
+        self.dwell_cumsum[lo:hi] = np.nancumsum(self.dwell[self.dwell_order[lo:hi]])
+
+    def _vessel_range(self, vessel_code):
+        if vessel_code < 0 or vessel_code >= len(self.vessel_offsets) - 1:
+            return 0, 0
+        return self.vessel_offsets[vessel_code], self.vessel_offsets[vessel_code + 1]
+
+    def vessel_rows(self, vessel_code, start_time=None, end_time=None):
+        """
+        Returns the rows of one vessel whose time lies in [start_time, end_time], sorted by time.
+
+        Requires build_index to have been called after the last extend.
+        """
+        lo, hi = self._vessel_range(vessel_code)
+        a, b = _time_window(self.vessel_time[lo:hi], start_time, end_time)
+        return self.vessel_order[lo + a:lo + b]
+
+    def vessel_path_columns(self, vessel_code, start_time, end_time, location_xy):
+        # 与 vessel_path 相同的点, 以 (时间数组, n x 2 坐标数组) 返回
+        rows = self.vessel_rows(vessel_code, start_time, end_time)
+        return self.time[rows], location_xy[self.source[rows]]
+
+    def simplified_path_columns(self, vessel_code, start_time, end_time, location_xy, max_points=None,
+                                tolerance=None):
+        """Like vessel_path_columns, simplified with simplify_path. Also returns the summed dwell of each point."""
+        rows = self.vessel_rows(vessel_code, start_time, end_time)
+        times, points = self.time[rows], location_xy[self.source[rows]]
+        kept, dwell = simplify_path(times, points, self.dwell[rows], max_points, tolerance)
+        return times[kept], points[kept], dwell
+
+    def vessel_path(self, vessel_code, start_time, end_time, location_xy, max_points=None, tolerance=None):
+        if max_points is None and tolerance is None:
+            times, points = self.vessel_path_columns(vessel_code, start_time, end_time, location_xy)
+            return [{'time': t, 'point': point} for t, point in zip(times.tolist(), points.tolist())]
+        # 简化后的每个点带上它所代表的 ping 的停留时间之和
+        times, points, dwell = self.simplified_path_columns(vessel_code, start_time, end_time, location_xy,
+                                                            max_points, tolerance)
+        return [{'time': t, 'point': point, 'dwell': d}
+                for t, point, d in zip(times.tolist(), points.tolist(), dwell.tolist())]
+
+    def vessel_dwell(self, vessel_code, start_time, end_time, location_xy):
+        # 按原始顺序处理, 与 /mc2/select_dwell 一直以来的行为一致: 每个地点第一次出现的 ping 不计入停留时间
+        rows = np.sort(self.vessel_rows(vessel_code, start_time, end_time))
+        sources = self.source[rows]
+        codes, first = np.unique(sources, return_index=True)
+        dwell = self.dwell[rows]
+        dwell[first] = 0
+        totals = np.bincount(sources, dwell, minlength=len(location_xy))
+
+        dwell_time = {}
+        for code in codes[np.argsort(first)].tolist():
+            x, y = location_xy[code].tolist()
+            dwell_time[self.locations.values[code]] = {'time': totals[code].item(), 'x': x, 'y': y}
+        return dwell_time
+
+    def window_dwell(self, vessel_code, start_time=None, end_time=None):
+        """
+        Total dwell of one vessel per location over pings with time in [start_time, end_time].
+
+        Each (vessel, location) group costs two binary searches and two prefix-sum lookups, independent of how many
+        pings fall in the window.
+
+        Returns:
+            (location codes, totals) arrays, ordered by location code, for locations with pings in the window.
+        """
+        lo, hi = self._vessel_range(vessel_code)
+        sources = self.dwell_source[lo:hi]
+        bounds = lo + np.searchsorted(sources, np.arange(len(self.locations) + 1))
+        codes = []
+        totals = []
+        for code in np.flatnonzero(bounds[1:] > bounds[:-1]).tolist():
+            g_lo, g_hi = bounds[code], bounds[code + 1]
+            a, b = _time_window(self.dwell_time[g_lo:g_hi], start_time, end_time)
+            if b > a:
+                codes.append(code)
+                totals.append(self.dwell_cumsum[g_lo + b - 1] - (self.dwell_cumsum[g_lo + a - 1] if a > 0 else 0))
+        return np.array(codes, dtype=np.int64), np.array(totals, dtype=np.float64)
+
+    def column(self, attribute, start=0):
+        # start 之后的行, 追加数据时只需要新行的值
+        if attribute == 'time':
+            return self.time[start:]
+        if attribute == 'dwell':
+            return self.dwell[start:]
+        if attribute == 'source':
+            return np.array(self.locations.values, dtype=object)[self.source[start:]]
+        if attribute == 'target':
+            return np.array(self.vessels.values, dtype=object)[self.target[start:]]
+        if attribute == 'key':
+            return np.array(self.keys.values, dtype=object)[self.key[start:]]
+        if attribute == 'type':
+            return np.full(len(self) - start, EventType.TransportEvent_TransponderPing, dtype=object)
+        if attribute == 'metadata':
+            return np.array([Metadata(*self.metadata_values.values[c]) for c in self.metadata[start:]], dtype=object)
+        raise KeyError(attribute)
+
+    def filter(self, attribute, func):
+        """
+        Returns the row numbers whose attribute satisfies func. Predicate instances are evaluated on the whole
+        column, any other callable once per row with the plain Python value, as for the other edge types.
+        """
+        column = self.column(attribute)
+        if isinstance(func, Predicate):
+            try:
+                mask = func(column)
+            except Exception:
+                mask = None
+            if isinstance(mask, np.ndarray) and mask.dtype == bool and mask.shape == column.shape:
+                return np.flatnonzero(mask)
+
+        # 普通函数 (比如 lambda t: t.month == 2) 只保证能处理单个值, 逐个元素判断
+        values = column.tolist()
+        return np.fromiter((i for i, v in enumerate(values) if func(v)), dtype=np.int64)
+
+    def row(self, i):
+        return TransponderPing(self.metadata_values.values[self.metadata[i]], self.time[i].item(),
+                               self.dwell[i].item(), self.locations.values[self.source[i]],
+                               self.vessels.values[self.target[i]], self.keys.values[self.key[i]])
+
+    def rows(self, indices=None):
+        if indices is None:
+            indices = range(len(self))
+        return [self.row(i) for i in indices]
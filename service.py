@@ -1,21 +1,125 @@
+import atexit
+import hashlib
 import json
+import threading
 import time
+from collections import deque
 from concurrent.futures import ProcessPoolExecutor
 
+import snapshot
+from embedding_index import EmbeddingIndex
+from suspect_cache import SuspectScoreCache, file_sha1
 from data_parser import EntityType, EventType
-from data_parser import parse_edge
-from data_parser import parse_geo_object
+from data_parser import parse_edge, parse_type
+from data_parser import parse_geo_object, compute_centroids
+from data_parser import iter_json_batches
 from data_parser.node_parser import *
 import numpy as np
-
-node_list = []
-edge_list = []
-
-# 保存vessel id->vessel
-id2vessel = {}
-id2location = {}
-# Location类型通过name查找geo feature
-name2geo = {}
+from indexing import INDEX_KINDS, Predicate, Eq
+from parallel_query import MP_CONTEXT, ParallelQueryExecutor
+from ping_table import PingTable, ping_columns
+
+
+# 一次 initialize 从数据文件和地理文件加载的全部内容, 查询只读取当时的 graph, 重新加载时整体替换
+# 旧的模块属性 (service.node_list, service.ping_table, ...) 仍然指向当前 graph 的字段
+class Graph:
+    __slots__ = ('node_list', 'edge_list', 'ping_table', 'node_partitions', 'edge_partitions', 'id2vessel',
+                 'id2location', 'name2geo', 'location_xy', 'indexes', 'parallel_executor', 'version', 'sources',
+                 'load_timings', 'fingerprint')
+
+    def __init__(self):
+        self.node_list = []
+        # TransponderPing 不放在 edge_list 里, 而是按列存放在 ping_table 中
+        self.edge_list = []
+        self.ping_table = PingTable()
+        # 按类型分区的节点和边, 与 node_list / edge_list 共享同一批对象
+        self.node_partitions = {}
+        self.edge_partitions = {}
+        # 保存vessel id->vessel
+        self.id2vessel = {}
+        self.id2location = {}
+        # Location类型通过name查找geo feature
+        self.name2geo = {}
+        # ping_table.locations 编码 -> 地点中心坐标, 没有地理信息的地点为 nan
+        self.location_xy = np.empty((0, 2))
+        # (类型, 属性) -> (该类型的对象列表, 索引), ping 的对象列表为 None, 位置即 ping_table 的行号
+        self.indexes = {}
+        # 读取这份数据的共享内存进程池, 见 enable_parallel_queries
+        self.parallel_executor = None
+        # 每次发布新的 graph 加一, 用于让缓存的查询结果失效
+        self.version = 0
+        # initialize 的参数, reload 默认沿用
+        self.sources = None
+        # 各加载阶段的耗时 (秒)
+        self.load_timings = {}
+        # 数据的指纹, 源文件和追加的记录相同时不变, 用作可疑分数缓存的键
+        self.fingerprint = None
+
+
+graph = Graph()
+
+# 二级索引声明 (类型, 属性) -> 索引种类, 每次 initialize 之后都会重建
+index_declarations = {
+    (EntityType.Vessel_FishingVessel, 'company'): 'hash',
+    (EntityType.Location_Point, 'kind'): 'hash',
+    (EntityType.Location_City, 'kind'): 'hash',
+    (EntityType.Location_Region, 'kind'): 'hash',
+    (EventType.TransportEvent_TransponderPing, 'target'): 'hash',
+    (EventType.TransportEvent_TransponderPing, 'time'): 'sorted',
+    (EventType.TransportEvent_TransponderPing, 'dwell'): 'sorted',
+    (EventType.Transaction, 'date'): 'sorted',
+    (EventType.HarborReport, 'date'): 'sorted',
+}
+
+# 多艘船的查询可以交给共享内存的进程池并行处理, 见 enable_parallel_queries
+parallel_config = None
+# 换下来的 graph 的进程池等这么久再关闭, 让还在用旧 graph 的查询先做完
+EXECUTOR_GRACE_SECONDS = 30
+# 还在宽限期内的旧进程池, 进程退出时不再等待, 直接关闭
+_retired_executors = set()
+# 追加数据后的 graph 先串行查询, 最多每隔这么久才把最新的数据重新共享给一个新的进程池
+APPEND_SHARE_DELAY = 10
+_share_timer = None
+
+# 同一时间只允许一次 reload
+_reload_lock = threading.Lock()
+# 发布新 graph 和追加数据互斥, 避免两次追加互相覆盖
+_write_lock = threading.RLock()
+reload_status = {'running': False, 'error': None}
+
+# 训练好的模型导出的船只嵌入近邻索引, 与数据无关, reload 之后继续使用, 见 load_embedding_index
+embedding_index = None
+
+# calculate_suspect 以这些船的停留向量之和作为可疑船的参考
+SUSPECT_REFERENCE_VESSELS = ['snappersnatcher7be']
+# 已知的可疑船, cal_suspect 用模型打分时的默认参考
+SUSPECT_VESSELS = [
+    'plaiceplundererba1',
+    'europeanseabassbuccaneer777',
+    'pompanoplunderere5d',
+    'roachrobberdb6',
+    'whitemarlinwranglerbac',
+    'huron1b3',
+    'opheliacac',
+    'wavewranglerc2d',
+    'bigeyetunabanditb73',
+    'arcticgraylingangler094',
+    'channelcatfishcapturer175',
+    'snappersnatcher7be'
+]
+# 可疑分数缓存文件, None 表示放在数据文件旁边 (data_file_path + '.suspect.json'), 见 select_suspect_scores
+SUSPECT_CACHE_PATH = None
+_suspect_caches = {}
+
+# 旧代码直接读取的模块属性, 转发到当前的 graph
+_GRAPH_ATTRIBUTES = {name: name for name in Graph.__slots__}
+_GRAPH_ATTRIBUTES['data_version'] = 'version'
+
+
+def __getattr__(name):
+    if name in _GRAPH_ATTRIBUTES:
+        return getattr(graph, _GRAPH_ATTRIBUTES[name])
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 def process_nodes(nodes):
@@ -35,22 +139,31 @@ def process_nodes(nodes):
 
 def process_edges(links):
     local_edge_list = []
+    local_pings = []
     for edge in links:
-        e = parse_edge(edge)
-        local_edge_list.append(e)
+        # ping 直接按列解析, 不创建 TransponderPing 对象
+        if parse_type(edge['type']) == EventType.TransportEvent_TransponderPing:
+            local_pings.append(edge)
+        else:
+            local_edge_list.append(parse_edge(edge))
 
-    return local_edge_list
+    # ping 以列的形式传回主进程, 避免逐个 pickle 对象
+    return local_edge_list, ping_columns(local_pings)
 
 
-def initialize(data_file_path, geo_file_path, num_workers=8):
-    global node_list, edge_list, id2vessel, id2location, name2geo
+def _parse_data(data_file_path, num_workers):
+    nodes = []
+    edges = []
+    pings = PingTable()
+    vessels = {}
+    locations = {}
 
     # 读取 JSON 文件
     with open(data_file_path, 'r') as f:
         data = json.load(f)
 
-    # 使用 ProcessPoolExecutor 进行并行处理
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+    # 使用 ProcessPoolExecutor 进行并行处理, 可能在 reload 的后台线程里启动, 所以不用 fork
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=MP_CONTEXT) as executor:
         # 分割节点
         num_nodes = len(data['nodes'])
         chunk_size_nodes = max(1, num_nodes // num_workers)
@@ -62,9 +175,9 @@ def initialize(data_file_path, geo_file_path, num_workers=8):
 
         # 合并节点处理结果
         for local_node_list, local_id2vessel, local_id2location in results_node:
-            node_list.extend(local_node_list)
-            id2vessel.update(local_id2vessel)
-            id2location.update(local_id2location)
+            nodes.extend(local_node_list)
+            vessels.update(local_id2vessel)
+            locations.update(local_id2location)
 
         # 分割边
         num_edges = len(data['links'])
@@ -76,73 +189,555 @@ def initialize(data_file_path, geo_file_path, num_workers=8):
         results_edge = [future.result() for future in futures_edge]
 
         # 合并边处理结果
-        for local_edge_list in results_edge:
-            edge_list.extend(local_edge_list)
-
-    # 读取并处理地理信息文件
-    name2geo.clear()
+        for local_edge_list, local_ping_columns in results_edge:
+            edges.extend(local_edge_list)
+            pings.extend(local_ping_columns)
+
+    pings.build_index()
+    return nodes, edges, pings, vessels, locations
+
+
+def _parse_data_streaming(data_file_path, num_workers, batch_size):
+    nodes = []
+    edges = []
+    pings = PingTable()
+    vessels = {}
+    locations = {}
+
+    def merge(key, future):
+        if key == 'nodes':
+            local_node_list, local_id2vessel, local_id2location = future.result()
+            nodes.extend(local_node_list)
+            vessels.update(local_id2vessel)
+            locations.update(local_id2location)
+        else:
+            local_edge_list, local_ping_columns = future.result()
+            edges.extend(local_edge_list)
+            pings.extend(local_ping_columns)
+
+    # 边读边解析, 同时最多只有 max_pending 个批次在排队, 内存占用与批大小成正比而不是与文件大小成正比
+    max_pending = 2 * num_workers
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=MP_CONTEXT) as executor:
+        for key, batch in iter_json_batches(data_file_path, ('nodes', 'links'), batch_size):
+            func = process_nodes if key == 'nodes' else process_edges
+            pending.append((key, executor.submit(func, batch)))
+            # 按提交顺序合并, 保证结果顺序与文件一致
+            if len(pending) >= max_pending:
+                merge(*pending.popleft())
+        while pending:
+            merge(*pending.popleft())
+
+    pings.build_index()
+    return nodes, edges, pings, vessels, locations
+
+
+def _parse_geo(geo_file_path):
+    geo = {}
     with open(geo_file_path, 'r') as f:
         geo_data = json.load(f)
         for node in geo_data['features']:
             n = parse_geo_object(node)
-            name2geo[n.id] = n
+            geo[n.id] = n
+    compute_centroids(list(geo.values()))
+    return geo
+
+
+def _build_location_xy(pings, locations, geo):
+    xy = np.full((len(pings.locations), 2), np.nan)
+    for code, location_id in enumerate(pings.locations.values):
+        location = locations.get(location_id)
+        if location is not None and location.name in geo:
+            xy[code] = geo[location.name].center()
+    return xy
+
+
+# 从数据文件和地理文件加载一个完整的 Graph, 不影响正在使用的 graph; snapshot_path 默认为 data_file_path + '.snapshot'
+def load_graph(data_file_path, geo_file_path, num_workers=8, snapshot_path=None, use_snapshot=True, streaming=False,
+               batch_size=10000):
+    g = Graph()
+    g.sources = {'data_file_path': data_file_path, 'geo_file_path': geo_file_path, 'num_workers': num_workers,
+                 'snapshot_path': snapshot_path, 'use_snapshot': use_snapshot, 'streaming': streaming,
+                 'batch_size': batch_size}
+    timings = g.load_timings
+    start = time.perf_counter()
+
+    # 快照默认放在数据文件旁边, 数据或地理文件有变化时会重新解析
+    if snapshot_path is None:
+        snapshot_path = data_file_path + '.snapshot'
+    source_paths = [data_file_path, geo_file_path]
+
+    t = time.perf_counter()
+    state = snapshot.load_snapshot(snapshot_path, source_paths) if use_snapshot else None
+    timings['snapshot_hit'] = state is not None
+    timings['snapshot_load'] = time.perf_counter() - t
+    if state is None:
+        t = time.perf_counter()
+        if streaming:
+            nodes, edges, pings, vessels, locations = _parse_data_streaming(data_file_path, num_workers, batch_size)
+        else:
+            nodes, edges, pings, vessels, locations = _parse_data(data_file_path, num_workers)
+        timings['parse_data'] = time.perf_counter() - t
+        # 读取并处理地理信息文件
+        t = time.perf_counter()
+        geo = _parse_geo(geo_file_path)
+        timings['parse_geo'] = time.perf_counter() - t
+        state = {
+            'node_list': nodes,
+            'edge_list': edges,
+            'ping_table': pings,
+            'id2vessel': vessels,
+            'id2location': locations,
+            'name2geo': geo,
+        }
+        if use_snapshot:
+            t = time.perf_counter()
+            snapshot.save_snapshot(snapshot_path, source_paths, state)
+            timings['snapshot_save'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    g.fingerprint = snapshot.dataset_fingerprint(snapshot_path if use_snapshot else None, source_paths)
+    timings['fingerprint'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    g.node_list = state['node_list']
+    g.edge_list = state['edge_list']
+    g.ping_table = state['ping_table']
+    g.id2vessel = state['id2vessel']
+    g.id2location = state['id2location']
+    g.name2geo = state['name2geo']
+    g.node_partitions = _partition(g.node_list)
+    g.edge_partitions = _partition(g.edge_list)
+    g.location_xy = _build_location_xy(g.ping_table, g.id2location, g.name2geo)
+    timings['partitions'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for (item_type, attribute), kind in index_declarations.items():
+        _build_index(g, item_type, attribute, kind)
+    timings['indexes'] = time.perf_counter() - t
+
+    if parallel_config is not None:
+        t = time.perf_counter()
+        g.parallel_executor = ParallelQueryExecutor(g.ping_table, g.location_xy, **parallel_config)
+        timings['parallel_queries'] = time.perf_counter() - t
+    timings['total'] = time.perf_counter() - start
+    return g
+
+
+# 之后的查询都读取 new_graph, 正在执行的查询仍然使用旧的 graph
+def publish_graph(new_graph):
+    global graph
+    with _write_lock:
+        old_graph = graph
+        new_graph.version = old_graph.version + 1
+        graph = new_graph
+    executor = old_graph.parallel_executor
+    if executor is not None and executor is not new_graph.parallel_executor:
+        with _write_lock:
+            _retired_executors.add(executor)
+        timer = threading.Timer(EXECUTOR_GRACE_SECONDS, _shutdown_retired, (executor,))
+        timer.daemon = True
+        timer.start()
+
+
+def _shutdown_retired(executor):
+    with _write_lock:
+        if executor not in _retired_executors:
+            return
+        _retired_executors.discard(executor)
+    executor.shutdown()
+
+
+@atexit.register
+def _shutdown_executors():
+    for executor in list(_retired_executors):
+        _shutdown_retired(executor)
+    if graph.parallel_executor is not None:
+        graph.parallel_executor.shutdown()
+
+
+def initialize(data_file_path, geo_file_path, num_workers=8, snapshot_path=None, use_snapshot=True, streaming=False,
+               batch_size=10000):
+    # 每次都加载一份完整的新 graph 替换旧的, 重复调用不会累积数据
+    publish_graph(load_graph(data_file_path, geo_file_path, num_workers, snapshot_path, use_snapshot, streaming,
+                             batch_size))
+
+
+def _reload_locked(overrides):
+    # 调用前已经拿到 _reload_lock, 结束时释放
+    reload_status['running'] = True
+    try:
+        new_graph = load_graph(**dict(graph.sources, **overrides))
+        publish_graph(new_graph)
+        reload_status['error'] = None
+        return new_graph.load_timings
+    except Exception as e:
+        reload_status['error'] = repr(e)
+        raise
+    finally:
+        reload_status['running'] = False
+        _reload_lock.release()
+
+
+def _acquire_reload():
+    if graph.sources is None:
+        raise RuntimeError('initialize has not been called')
+    return _reload_lock.acquire(blocking=False)
+
+
+# 用上次 initialize 的参数 (可以被 overrides 覆盖) 重新加载数据并原子替换, 返回新 graph 的加载耗时
+def reload(**overrides):
+    if not _acquire_reload():
+        raise RuntimeError('A reload is already running')
+    return _reload_locked(overrides)
+
+
+# 在后台线程里 reload, 已经在加载时返回 False
+def start_reload(**overrides):
+    if not _acquire_reload():
+        return False
+    reload_status['running'] = True
+
+    def run():
+        try:
+            _reload_locked(overrides)
+        except Exception:
+            # 错误已经记录在 reload_status 里
+            pass
+
+    threading.Thread(target=run, name='mc2-reload', daemon=True).start()
+    return True
+
+
+def _update_location_xy(g, changed_location_ids):
+    # 新出现的地点编码, 以及新加入 Location 节点的地点, 重新计算坐标
+    xy = np.full((len(g.ping_table.locations), 2), np.nan)
+    xy[:len(g.location_xy)] = g.location_xy
+    codes = set(range(len(g.location_xy), len(xy)))
+    codes.update(c for c in g.ping_table.locations.lookup(list(changed_location_ids)).tolist() if c >= 0)
+    for code in codes:
+        location = g.id2location.get(g.ping_table.locations.values[code])
+        if location is not None and location.name in g.name2geo:
+            xy[code] = g.name2geo[location.name].center()
+    return xy
+
+
+# 不重新加载, 把 mc2.json 格式的节点和边增量加入数据并发布为新的 graph, 不写入数据文件和 snapshot
+# 每次调用都复制一遍列数组, 开启并行查询时最多每 APPEND_SHARE_DELAY 秒共享一次, 所以应该批量追加
+def append_records(nodes=(), links=()):
+    nodes, links = list(nodes), list(links)
+    new_nodes, new_vessels, new_locations = process_nodes(nodes)
+    new_edges, new_pings = process_edges(links)
+
+    with _write_lock:
+        old = graph
+        g = Graph()
+        g.sources = old.sources
+        g.load_timings = old.load_timings
+        g.fingerprint = hashlib.sha1(json.dumps([old.fingerprint, nodes, links], sort_keys=True,
+                                                default=str).encode('utf-8')).hexdigest()
+        g.name2geo = old.name2geo
+        g.node_list = old.node_list + new_nodes
+        g.edge_list = old.edge_list + new_edges
+        g.id2vessel = {**old.id2vessel, **new_vessels}
+        g.id2location = {**old.id2location, **new_locations}
+
+        # 只复制有新对象的分区, 新对象在分区中的位置从旧分区的长度开始
+        starts = {}
+        g.node_partitions = dict(old.node_partitions)
+        g.edge_partitions = dict(old.edge_partitions)
+        for partitions, items in ((g.node_partitions, new_nodes), (g.edge_partitions, new_edges)):
+            for item_type, typed in _partition(items).items():
+                starts[item_type] = len(partitions.get(item_type, []))
+                partitions[item_type] = partitions.get(item_type, []) + typed
+
+        ping_start = len(old.ping_table)
+        g.ping_table = old.ping_table.appended(new_pings) if len(new_pings['time']) else old.ping_table
+        g.location_xy = old.location_xy
+        g.location_xy = _update_location_xy(g, new_locations)
+
+        g.indexes = dict(old.indexes)
+        for (item_type, attribute), (items, index) in old.indexes.items():
+            if item_type == EventType.TransportEvent_TransponderPing:
+                if len(g.ping_table) > ping_start:
+                    g.indexes[(item_type, attribute)] = (None, index.appended(
+                        g.ping_table.column(attribute, ping_start), ping_start))
+            elif item_type in starts:
+                start = starts[item_type]
+                items = _typed_items(g, item_type)
+                values = [getattr(item, attribute, None) for item in items[start:]]
+                g.indexes[(item_type, attribute)] = (items, index.appended(values, start))
+
+        if parallel_config is not None:
+            _schedule_share()
+        publish_graph(g)
+
+
+def _schedule_share():
+    # 已经有等待中的共享时不再安排, 到时会共享当时最新的 graph
+    global _share_timer
+    with _write_lock:
+        if _share_timer is None:
+            _share_timer = threading.Timer(APPEND_SHARE_DELAY, _share_appended)
+            _share_timer.daemon = True
+            _share_timer.start()
+
+
+def _share_appended():
+    global _share_timer
+    with _write_lock:
+        _share_timer = None
+        g = graph
+        if parallel_config is not None and g.parallel_executor is None:
+            g.parallel_executor = ParallelQueryExecutor(g.ping_table, g.location_xy, **parallel_config)
+
+
+def append_node(node):
+    append_records(nodes=[node])
+
+
+def append_link(link):
+    append_records(links=[link])
+
+
+def _partition(items):
+    partitions = {}
+    for item in items:
+        partitions.setdefault(item.type, []).append(item)
+    return partitions
+
+
+def _typed_items(g, item_type):
+    if isinstance(item_type, EntityType):
+        return g.node_partitions.get(item_type, [])
+    return g.edge_partitions.get(item_type, [])
+
+
+def _build_index(g, item_type, attribute, kind):
+    if item_type == EventType.TransportEvent_TransponderPing:
+        items = None
+        values = g.ping_table.column(attribute)
+    else:
+        items = _typed_items(g, item_type)
+        values = [getattr(item, attribute, None) for item in items]
+    g.indexes[(item_type, attribute)] = (items, INDEX_KINDS[kind](values))
+
+
+# 为 (item_type, attribute) 声明并建立二级索引, kind 为 'hash' (Eq/In) 或 'sorted' (Between/Eq)
+def create_index(item_type, attribute, kind='hash'):
+    index_declarations[(item_type, attribute)] = kind
+    _build_index(graph, item_type, attribute, kind)
+
+
+def drop_index(item_type, attribute):
+    index_declarations.pop((item_type, attribute), None)
+    graph.indexes.pop((item_type, attribute), None)
+
+
+# 选出某一类型中满足所有条件的节点或边, 有索引的条件查索引, 其余的在候选里逐个检查
+# 例: select_where(EventType.TransportEvent_TransponderPing, time=Between(start, end), target=Eq(vessel_id))
+def select_where(item_type, **predicates):
+    g = graph
+    is_ping = item_type == EventType.TransportEvent_TransponderPing
+    items = None
+    positions = None
+    remaining = {}
+    for attribute, predicate in predicates.items():
+        entry = g.indexes.get((item_type, attribute))
+        if entry is not None and isinstance(predicate, Predicate) and entry[1].supports(predicate):
+            items = entry[0]
+            found = entry[1].lookup(predicate)
+            positions = found if positions is None else np.intersect1d(positions, found)
+        else:
+            remaining[attribute] = predicate
+
+    if is_ping:
+        for attribute, predicate in remaining.items():
+            found = g.ping_table.filter(attribute, predicate)
+            positions = found if positions is None else np.intersect1d(positions, found)
+        return g.ping_table.rows(np.arange(len(g.ping_table)) if positions is None else positions)
+
+    if items is None:
+        items = _typed_items(g, item_type)
+    candidates = items if positions is None else [items[p] for p in positions.tolist()]
+    return [item for item in candidates
+            if all(func(getattr(item, attribute, None)) for attribute, func in remaining.items())]
 
 
 def select_nodes(func):
     results = []
-    for node in node_list:
+    for node in graph.node_list:
         if func(node):
             results.append(node)
     return results
 
 
 def select_edge(func):
+    g = graph
     results = []
-    for edge in edge_list:
+    for edge in g.edge_list:
+        if func(edge):
+            results.append(edge)
+    for edge in g.ping_table.rows():
         if func(edge):
             results.append(edge)
     return results
 
 
 def select_entity_attribute(entity_type, attribute, func):
+    if isinstance(func, Predicate):
+        return select_where(entity_type, **{attribute: func})
+
     results = []
-    for node in node_list:
-        if node.type == entity_type:
-            if func(node.__dict__[attribute]):
-                results.append(node)
+    for node in graph.node_partitions.get(entity_type, []):
+        if func(getattr(node, attribute)):
+            results.append(node)
     return results
 
 
 def select_edge_attribute(edge_type, attribute, func):
+    if isinstance(func, Predicate):
+        return select_where(edge_type, **{attribute: func})
+    g = graph
+    if edge_type == EventType.TransportEvent_TransponderPing:
+        return g.ping_table.rows(g.ping_table.filter(attribute, func))
+
     results = []
-    for edge in edge_list:
-        if edge.type == edge_type:
-            if func(edge.__dict__[attribute]):
-                results.append(edge)
+    for edge in g.edge_partitions.get(edge_type, []):
+        if func(getattr(edge, attribute)):
+            results.append(edge)
     return results
 
 
 def select_vessel_by_id(vessel_id):
-    return id2vessel[vessel_id]
+    return graph.id2vessel[vessel_id]
 
 
 def select_location_by_id(location_id):
-    return id2location[location_id]
+    return graph.id2location[location_id]
 
 
 def select_geo_by_id(location_id):
-    location = id2location[location_id]
-    return name2geo[location.name]
+    g = graph
+    location = g.id2location[location_id]
+    return g.name2geo[location.name]
 
 
-def select_fishing_vessel_by_company(company):
-    results = []
-    for vessel in id2vessel.values():
-        if vessel.type == EntityType.Vessel_FishingVessel:
+def select_vessel_pings(vessel_id, start_time=None, end_time=None):
+    # 返回 ping_table 的行号, 已按时间排序
+    ping_table = graph.ping_table
+    return ping_table.vessel_rows(ping_table.vessels.get(vessel_id), start_time, end_time)
+
+
+# 一艘船在 [start_time, end_time] 内的 ping, 给出 max_points 或 tolerance 时简化路径, 每个点带上合并的 dwell
+def select_vessel_path(vessel_id, start_time=None, end_time=None, max_points=None, tolerance=None):
+    return _vessel_path(graph, vessel_id, start_time, end_time, max_points, tolerance)
+
+
+def _vessel_path(g, vessel_id, start_time, end_time, max_points=None, tolerance=None):
+    return g.ping_table.vessel_path(g.ping_table.vessels.get(vessel_id), start_time, end_time, g.location_xy,
+                                    max_points, tolerance)
+
+
+def select_vessel_path_columns(vessel_ids, start_time=None, end_time=None, max_points=None, tolerance=None):
+    # 每艘船返回 (船 id, 时间数组, 坐标数组, 停留时间数组), 供二进制响应使用; 不简化时停留时间为 None
+    g = graph
+    ping_table, location_xy = g.ping_table, g.location_xy
+    if max_points is None and tolerance is None:
+        return [(v, *ping_table.vessel_path_columns(ping_table.vessels.get(v), start_time, end_time, location_xy),
+                 None) for v in vessel_ids]
+    return [(v, *ping_table.simplified_path_columns(ping_table.vessels.get(v), start_time, end_time, location_xy,
+                                                    max_points, tolerance)) for v in vessel_ids]
+
+
+def select_vessel_dwell(vessel_id, start_time=None, end_time=None):
+    return _vessel_dwell(graph, vessel_id, start_time, end_time)
+
+
+def _vessel_dwell(g, vessel_id, start_time, end_time):
+    return g.ping_table.vessel_dwell(g.ping_table.vessels.get(vessel_id), start_time, end_time, g.location_xy)
+
+
+# 超过 serial_cutoff 艘船的路径/停留查询交给 num_workers 个进程, 从共享内存读取 ping 数据, initialize 和 reload 后仍然有效
+def enable_parallel_queries(num_workers=4, serial_cutoff=8):
+    global parallel_config
+    disable_parallel_queries()
+    parallel_config = {'num_workers': num_workers, 'serial_cutoff': serial_cutoff}
+    g = graph
+    g.parallel_executor = ParallelQueryExecutor(g.ping_table, g.location_xy, num_workers, serial_cutoff)
+
+
+def disable_parallel_queries():
+    global parallel_config
+    g = graph
+    if g.parallel_executor is not None:
+        g.parallel_executor.shutdown()
+    parallel_config = None
+    g.parallel_executor = None
+
+
+def select_vessel_paths(vessel_ids, start_time=None, end_time=None, max_points=None, tolerance=None):
+    # 简化后的结果很小, 直接在本进程里算
+    g = graph
+    if g.parallel_executor is not None and max_points is None and tolerance is None:
+        paths = g.parallel_executor.vessel_paths(vessel_ids, start_time, end_time)
+    else:
+        paths = [_vessel_path(g, v, start_time, end_time, max_points, tolerance) for v in vessel_ids]
+    return [{'vessel': v, 'path': path} for v, path in zip(vessel_ids, paths)]
 
-            if vessel.company == company:
-                results.append(vessel)
-    return results
+
+def select_vessel_dwells(vessel_ids, start_time=None, end_time=None):
+    g = graph
+    if g.parallel_executor is not None:
+        dwells = g.parallel_executor.vessel_dwells(vessel_ids, start_time, end_time)
+    else:
+        dwells = [_vessel_dwell(g, v, start_time, end_time) for v in vessel_ids]
+    return [{'vessel': v, 'dwell': dwell} for v, dwell in zip(vessel_ids, dwells)]
+
+
+def iter_vessel_paths(vessel_ids, start_time=None, end_time=None, max_points=None, tolerance=None):
+    # 与 select_vessel_paths 相同, 但逐艘船生成结果
+    g = graph
+    if g.parallel_executor is not None and max_points is None and tolerance is None:
+        paths = g.parallel_executor.iter_vessel_paths(vessel_ids, start_time, end_time)
+    else:
+        paths = (_vessel_path(g, v, start_time, end_time, max_points, tolerance) for v in vessel_ids)
+    for v, path in zip(vessel_ids, paths):
+        yield {'vessel': v, 'path': path}
+
+
+def iter_vessel_dwells(vessel_ids, start_time=None, end_time=None):
+    g = graph
+    if g.parallel_executor is not None:
+        dwells = g.parallel_executor.iter_vessel_dwells(vessel_ids, start_time, end_time)
+    else:
+        dwells = (_vessel_dwell(g, v, start_time, end_time) for v in vessel_ids)
+    for v, dwell in zip(vessel_ids, dwells):
+        yield {'vessel': v, 'dwell': dwell}
+
+
+# 用加载时建立的前缀和计算一艘船在 [start_time, end_time] 内每个地点的总停留时间, 每个 ping 都计入
+def select_vessel_dwell_window(vessel_id, start_time=None, end_time=None):
+    return _vessel_dwell_window(graph, vessel_id, start_time, end_time)
+
+
+def _vessel_dwell_window(g, vessel_id, start_time, end_time):
+    ping_table = g.ping_table
+    codes, totals = ping_table.window_dwell(ping_table.vessels.get(vessel_id), start_time, end_time)
+    dwell_time = {}
+    for code, total in zip(codes.tolist(), totals.tolist()):
+        x, y = g.location_xy[code].tolist()
+        dwell_time[ping_table.locations.values[code]] = {'time': total, 'x': x, 'y': y}
+    return dwell_time
+
+
+def select_vessel_dwell_windows(vessel_ids, start_time=None, end_time=None):
+    g = graph
+    return [{'vessel': v, 'dwell': _vessel_dwell_window(g, v, start_time, end_time)} for v in vessel_ids]
+
+
+def select_fishing_vessel_by_company(company):
+    return select_where(EntityType.Vessel_FishingVessel, company=Eq(company))
 
 
 def normalize(v):
@@ -154,66 +749,194 @@ def normalize(v):
 
 def select_preserve():
     result = []
-    for name, l in id2location.items():
-        if l.kind == "Ecological Preserve":
-            result.append(name)
+    for location_type in (EntityType.Location_Point, EntityType.Location_City, EntityType.Location_Region):
+        for l in select_where(location_type, kind=Eq("Ecological Preserve")):
+            result.append(l.id)
     return result
 
 
 def select_dwell_vector(vessel_id, norm=False, location_list=None, weight_mapping=None):
-    locations = id2location.keys() if location_list is None else location_list
-    location_idx_mapping = {l: idx for idx, l in enumerate(locations)}
+    g = graph
+    ping_table = g.ping_table
+    locations = list(g.id2location.keys()) if location_list is None else location_list
     location_vector = np.zeros(len(locations))
-    for edge in edge_list:
-        if edge.type == EventType.TransportEvent_TransponderPing:
-            if edge.target == vessel_id:
-                location_name = edge.source
-                if location_name not in location_idx_mapping.keys():
-                    continue
-                dwell = edge.dwell
-                location_vector[location_idx_mapping[location_name]] += dwell * weight_mapping.get(location_name, 1)
+    vessel_code = ping_table.vessels.get(vessel_id)
+    if vessel_code >= 0:
+        # ping_table 中的地点编码 -> location_vector 的下标, 不在 locations 里的为 -1
+        location_codes = ping_table.locations.lookup(locations)
+        known = location_codes >= 0
+        location_idx_mapping = np.full(len(ping_table.locations), -1)
+        location_idx_mapping[location_codes[known]] = np.flatnonzero(known)
+        weights = np.array([1 if weight_mapping is None else weight_mapping.get(l, 1) for l in locations],
+                           dtype=np.float64)
+
+        mask = ping_table.target == vessel_code
+        idx = location_idx_mapping[ping_table.source[mask]]
+        dwell = ping_table.dwell[mask]
+        valid = idx >= 0
+        np.add.at(location_vector, idx[valid], dwell[valid] * weights[idx[valid]])
     if norm:
         location_vector = normalize(location_vector)
     return location_vector
 
 
 def select_transponder_ping():
+    ping_table = graph.ping_table
     vessel_transponderping = {}
-    for edge in edge_list:
-        if edge.type == EventType.TransportEvent_TransponderPing:
-            if edge.target not in vessel_transponderping.keys():
-                vessel_transponderping[edge.target] = []
-            vessel_transponderping[edge.target].append({
-                'time': edge.time,
-                'dwell': edge.dwell,
-                'source': edge.source
-            })
+    times = ping_table.time.tolist()
+    dwells = ping_table.dwell.tolist()
+    locations = ping_table.locations.values
+    vessels = ping_table.vessels.values
+    # 稳定排序保证每艘船内部仍是原始顺序
+    order = np.argsort(ping_table.target, kind='stable')
+    bounds = np.searchsorted(ping_table.target[order], np.arange(len(vessels) + 1))
+    for code, vessel_id in enumerate(vessels):
+        rows = order[bounds[code]:bounds[code + 1]].tolist()
+        vessel_transponderping[vessel_id] = [{
+            'time': times[i],
+            'dwell': dwells[i],
+            'source': locations[ping_table.source[i]]
+        } for i in rows]
     return vessel_transponderping
 
-def calculate_suspect():
+# select_transponder_ping 的数组形式, 供 model.preprocess_arrays 使用
+# 返回 ({vessel id: 按时间排序的 (time, dwell, source code)}, 每个 source code 对应的地点 id)
+def select_transponder_ping_arrays():
+    ping_table = graph.ping_table
+    ping_arrays = {}
+    for code, vessel_id in enumerate(ping_table.vessels.values):
+        rows = ping_table.vessel_rows(code)
+        ping_arrays[vessel_id] = (ping_table.time[rows], ping_table.dwell[rows], ping_table.source[rows])
+    return ping_arrays, ping_table.locations.values
+
+
+# 遍历一次 ping_table 得到 船 x 地点 的停留矩阵, 第 i 行等于 select_dwell_vector(vessel_ids[i], ...)
+# 返回 (matrix, vessel_ids, locations), sparse 为 True 时返回 scipy.sparse CSR 矩阵
+def select_dwell_matrix(vessel_ids=None, location_list=None, weight_mapping=None, norm=False, sparse=False):
+    g = graph
+    ping_table = g.ping_table
+    if vessel_ids is None:
+        vessel_ids = [v.id for v in g.node_partitions.get(EntityType.Vessel_FishingVessel, [])]
+    locations = list(g.id2location.keys()) if location_list is None else location_list
+    shape = (len(vessel_ids), len(locations))
+
+    # ping_table 编码 -> 矩阵行列下标, 不需要的船和地点为 -1
+    vessel_codes = ping_table.vessels.lookup(vessel_ids)
+    location_codes = ping_table.locations.lookup(locations)
+    row_mapping = np.full(len(ping_table.vessels), -1)
+    row_mapping[vessel_codes[vessel_codes >= 0]] = np.flatnonzero(vessel_codes >= 0)
+    col_mapping = np.full(len(ping_table.locations), -1)
+    col_mapping[location_codes[location_codes >= 0]] = np.flatnonzero(location_codes >= 0)
+    weights = np.array([1 if weight_mapping is None else weight_mapping.get(l, 1) for l in locations],
+                       dtype=np.float64)
+
+    rows = row_mapping[ping_table.target]
+    cols = col_mapping[ping_table.source]
+    valid = (rows >= 0) & (cols >= 0)
+    rows, cols = rows[valid], cols[valid]
+    dwell = ping_table.dwell[valid] * weights[cols]
+    matrix = np.bincount(rows * shape[1] + cols, dwell, minlength=shape[0] * shape[1]).reshape(shape)
+
+    if norm:
+        row_norm = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = np.divide(matrix, row_norm, out=matrix, where=row_norm != 0)
+    if sparse:
+        from scipy.sparse import csr_matrix
+        matrix = csr_matrix(matrix)
+    return matrix, vessel_ids, locations
+
+
+# 读取 model.py 保存的船只嵌入索引 (embedding_index.EmbeddingIndex.save)
+def load_embedding_index(path):
+    global embedding_index
+    embedding_index = EmbeddingIndex.load(path)
+    return embedding_index
+
+
+# 与 vessel_id 嵌入最接近的 k 艘船, 没有加载索引时抛出 RuntimeError, 船没有嵌入时抛出 KeyError
+def select_similar_vessels(vessel_id, k=10, approximate=False):
+    index = embedding_index
+    if index is None:
+        raise RuntimeError('No vessel embedding index loaded')
+    g = graph
+    result = []
+    for other_id, similarity in index.most_similar(vessel_id, k, approximate):
+        vessel = g.id2vessel.get(other_id)
+        result.append({
+            'vessel': other_id,
+            'name': getattr(vessel, 'name', None),
+            'company': getattr(vessel, 'company', None),
+            'similarity': similarity,
+        })
+    return result
+
+
+# 按停留向量与可疑船只的接近程度给每艘渔船打分, 生态保护区加权, 返回 {company: {'suspect_ratio', 'vessels'}}
+def suspect_scores(suspects=None):
+    g = graph
     preserve_list = select_preserve()
     weight_mapping = {l: 10 for l in preserve_list}
-    x1 = select_dwell_vector('snappersnatcher7be', norm=False, weight_mapping=weight_mapping)
+    x1 = sum(select_dwell_vector(v, norm=False, weight_mapping=weight_mapping)
+             for v in (SUSPECT_REFERENCE_VESSELS if suspects is None else suspects))
     x1 += 50000
-    for idx, l in enumerate(id2location.keys()):
+    for idx, l in enumerate(g.id2location.keys()):
         if l in preserve_list:
             x1[idx] += 500000
     x1 = normalize(x1)
+
+    # 所有渔船的停留矩阵只需要扫描一遍 ping_table, 再用一次矩阵向量乘法打分
+    vessels = g.node_partitions.get(EntityType.Vessel_FishingVessel, [])
+    d_matrix, _, _ = select_dwell_matrix([v.id for v in vessels], norm=True, weight_mapping=weight_mapping)
+    suspect_ratios = d_matrix @ x1
+
     result = {}
-    for vessel in id2vessel.values():
-        if vessel.type == EntityType.Vessel_FishingVessel:
-            company = vessel.company
-            v_id = vessel.id
-            d_vector = select_dwell_vector(v_id, norm=True, weight_mapping=weight_mapping)
-            if company == 'SouthSeafood Express Corp':
-                continue
-            if company not in result.keys():
-                result[company] = {'suspect_ratio': 0, 'vessels': {}}
-            suspect_ratio = x1 @ d_vector
-            result[company]['suspect_ratio'] = max(result[company]['suspect_ratio'], suspect_ratio)
-            result[company]['vessels'][v_id] = suspect_ratio
-    with open('suspect.json', 'w') as json_file:
+    for vessel, suspect_ratio in zip(vessels, suspect_ratios):
+        company = vessel.company
+        v_id = vessel.id
+        if company == 'SouthSeafood Express Corp':
+            continue
+        if company not in result.keys():
+            result[company] = {'suspect_ratio': 0, 'vessels': {}}
+        result[company]['suspect_ratio'] = max(result[company]['suspect_ratio'], suspect_ratio)
+        result[company]['vessels'][v_id] = suspect_ratio
+    return result
+
+
+def calculate_suspect(output_path='suspect.json'):
+    result = suspect_scores()
+    with open(output_path, 'w') as json_file:
         json.dump(result, json_file, indent=4)
+    return result
+
+
+# 从缓存读取可疑分数, 只有模型参数, 可疑船只列表或数据变化时才重新计算, 返回 (entry, 是否重新计算)
+# 没有 model_path 时是 suspect_scores 的分数, 有 model_path 时是 cal_suspect 的嵌入分数 (需要 torch)
+def select_suspect_scores(model_path=None, suspects=None, recompute=False):
+    g = graph
+    if g.sources is None:
+        raise RuntimeError('No dataset loaded')
+    if suspects is None:
+        suspects = SUSPECT_REFERENCE_VESSELS if model_path is None else SUSPECT_VESSELS
+    suspects = list(suspects)
+    inputs = {
+        'scorer': 'dwell' if model_path is None else 'model',
+        'model_sha1': None if model_path is None else file_sha1(model_path),
+        'suspects': suspects,
+        'dataset': g.fingerprint,
+    }
+
+    def compute():
+        if model_path is None:
+            return suspect_scores(suspects)
+        # 只有需要重新计算时才导入 torch
+        import cal_suspect
+        vessels = [v for v in g.id2vessel.values() if v.type == EntityType.Vessel_FishingVessel]
+        ship_mapping = {k: v for v, k in enumerate(g.id2vessel.keys())}
+        return cal_suspect.cal_suspect(cal_suspect.load_model(model_path), ship_mapping, vessels, suspects)
+
+    path = SUSPECT_CACHE_PATH or g.sources['data_file_path'] + '.suspect.json'
+    cache = _suspect_caches.setdefault(path, SuspectScoreCache(path))
+    return cache.get_or_compute(inputs, compute, recompute)
 
 
 # if __name__ == '__main__':
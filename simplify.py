@@ -0,0 +1,98 @@
+"""
+Server-side simplification of vessel paths.
+
+simplify_path picks a subset of the pings of one path, always including the first and the last one:
+
+1. consecutive pings at the same point are merged into the first of them,
+2. with max_points, the remaining interior points are split into max_points - 2 equal time buckets and the point
+   with the largest dwell is kept from each bucket,
+3. with a tolerance, Douglas-Peucker drops points closer than tolerance to the simplified line.
+
+Bucketing runs before Douglas-Peucker so that its cost is bounded by max_points when both are given.
+
+Every kept point carries the summed dwell of the pings from it up to the next kept point, so the total dwell of a
+path is the same before and after simplification. All steps work on whole NumPy arrays; Douglas-Peucker processes
+every open segment of one recursion level at once.
+"""
+import numpy as np
+
+
+def _collapse_runs(points):
+    # 连续停在同一位置的 ping 只保留第一个, 最后一个 ping 始终保留
+    starts = np.ones(len(points), dtype=bool)
+    starts[1:-1] = np.any(points[1:-1] != points[:-2], axis=1)
+    return np.flatnonzero(starts)
+
+
+def _segment_distance(p, a, b):
+    # 点 p 到线段 ab 的距离, a == b 时为到 a 的距离
+    ab = b - a
+    length2 = np.einsum('ij,ij->i', ab, ab)
+    t = np.einsum('ij,ij->i', p - a, ab) / np.where(length2 > 0, length2, 1)
+    closest = a + np.clip(t, 0, 1)[:, None] * ab
+    return np.hypot(*(p - closest).T)
+
+
+def _douglas_peucker(points, tolerance):
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    lo = np.array([0])
+    hi = np.array([n - 1])
+    while len(lo):
+        lengths = hi - lo - 1
+        open_ = lengths > 0
+        lo, hi, lengths = lo[open_], hi[open_], lengths[open_]
+        if not len(lo):
+            break
+        # 这一层所有线段的内部点拼成一个数组一起计算距离
+        starts = np.cumsum(lengths) - lengths
+        segment = np.repeat(np.arange(len(lo)), lengths)
+        index = np.arange(lengths.sum()) - starts[segment] + lo[segment] + 1
+        distance = _segment_distance(points[index], points[lo[segment]], points[hi[segment]])
+        farthest = index[np.lexsort((-distance, segment))[starts]]
+        split = np.maximum.reduceat(distance, starts) > tolerance
+        mid = farthest[split]
+        keep[mid] = True
+        lo, hi = np.concatenate([lo[split], mid]), np.concatenate([mid, hi[split]])
+    return np.flatnonzero(keep)
+
+
+def _time_buckets(times, dwell, max_points):
+    n = len(times)
+    buckets = max_points - 2
+    if buckets <= 0:
+        return np.array([0, n - 1])
+    t = times.astype(np.int64)
+    bucket = (t[1:-1] - t[0]) * buckets // (t[-1] - t[0] + 1)
+    order = np.lexsort((-dwell[1:-1], bucket))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = bucket[order[1:]] != bucket[order[:-1]]
+    return np.concatenate([[0], np.sort(order[first]) + 1, [n - 1]])
+
+
+def simplify_path(times, points, dwell, max_points=None, tolerance=None):
+    """
+    Args:
+        times: datetime64 array of ping times, sorted
+        points: n x 2 array of ping coordinates
+        dwell: dwell time of each ping
+        max_points: upper bound on the number of returned points, at least 2
+        tolerance: Douglas-Peucker distance tolerance, in coordinate units
+
+    Returns:
+        (indices of the kept pings, summed dwell of each kept ping)
+    """
+    if max_points is not None and max_points < 2:
+        raise ValueError('max_points must be at least 2')
+    if tolerance is not None and tolerance < 0:
+        raise ValueError('tolerance must not be negative')
+    if len(times) <= 2:
+        return np.arange(len(times)), np.asarray(dwell, dtype=np.float64)
+
+    kept = _collapse_runs(points)
+    if max_points is not None and len(kept) > max_points:
+        kept = kept[_time_buckets(times[kept], np.add.reduceat(dwell, kept), max_points)]
+    if tolerance is not None and len(kept) > 2:
+        kept = kept[_douglas_peucker(points[kept], tolerance)]
+    return kept, np.add.reduceat(dwell, kept)
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+
+# 快照格式变化时需要增加版本号, 旧快照会被自动丢弃
+SNAPSHOT_VERSION = 9
+SNAPSHOT_MAGIC = b'FESNAP'
+
+_HEADER = struct.Struct('<6sHI')
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': file_hash(path)}
+
+
+def _source_matches(stored, path):
+    stat = os.stat(path)
+    if stored['size'] != stat.st_size:
+        return False
+    if stored['mtime'] == stat.st_mtime_ns:
+        return True
+    # mtime 变了但大小没变, 可能只是 touch 过, 用内容哈希确认
+    return stored['sha1'] == file_hash(path)
+
+
+def read_header(snapshot_path):
+    with open(snapshot_path, 'rb') as f:
+        magic, version, key_len = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            return None
+        return json.loads(f.read(key_len).decode('utf-8'))
+
+
+def load_snapshot(snapshot_path, source_paths):
+    """
+    Loads a snapshot written by save_snapshot if it is still valid for the given source files.
+
+    Args:
+        snapshot_path (str): Path of the snapshot file.
+        source_paths (list): Files the snapshot was built from, in the order they were passed to save_snapshot.
+
+    Returns:
+        The pickled state, or None if the snapshot is missing, from another version, stale or corrupt.
+    """
+    if not os.path.exists(snapshot_path):
+        return None
+    try:
+        key = read_header(snapshot_path)
+    except (OSError, ValueError, struct.error):
+        return None
+    if key is None or len(key['sources']) != len(source_paths):
+        return None
+    for stored, path in zip(key['sources'], source_paths):
+        if not os.path.exists(path) or not _source_matches(stored, path):
+            return None
+
+    with open(snapshot_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = _HEADER.size + _HEADER.unpack_from(mm)[2]
+            with memoryview(mm)[offset:] as payload:
+                # 快照被截断或损坏时重新解析, 解析完会覆盖这个快照
+                try:
+                    return pickle.loads(payload)
+                except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+                    return None
+
+
+def dataset_fingerprint(snapshot_path, source_paths):
+    """
+    Fingerprint of the parsed dataset: a hash of the snapshot version and the SHA-1 of every source file. The file
+    hashes come from the snapshot header while it still matches the files, so only a missing or stale snapshot makes
+    this read the sources.
+    """
+    stored = None
+    if snapshot_path is not None and os.path.exists(snapshot_path):
+        try:
+            key = read_header(snapshot_path)
+        except (OSError, ValueError, struct.error):
+            key = None
+        if key is not None and len(key['sources']) == len(source_paths):
+            stored = key['sources']
+    hashes = []
+    for i, path in enumerate(source_paths):
+        stat = os.stat(path)
+        if stored is not None and (stored[i]['mtime'], stored[i]['size']) == (stat.st_mtime_ns, stat.st_size):
+            hashes.append(stored[i]['sha1'])
+        else:
+            hashes.append(file_hash(path))
+    return hashlib.sha1(json.dumps([SNAPSHOT_VERSION, hashes]).encode('utf-8')).hexdigest()
+
+
+def save_snapshot(snapshot_path, source_paths, state):
+    key = json.dumps({'sources': [file_fingerprint(path) for path in source_paths]}).encode('utf-8')
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(key)))
+        f.write(key)
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # 先写临时文件再替换, 避免其他进程读到写了一半的快照
+    os.replace(tmp_path, snapshot_path)
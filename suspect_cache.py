@@ -0,0 +1,70 @@
+"""
+On-disk cache of suspect scores, keyed by fingerprints of everything that produced them.
+
+Each entry is stored under the SHA-1 of its inputs (scorer, model weights hash, suspect list, dataset fingerprint)
+together with those inputs, so the file records which model and dataset a score came from. The file is read on
+first use and rewritten atomically after every new entry; only the MAX_ENTRIES most recent entries are kept.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+import snapshot
+
+MAX_ENTRIES = 8
+
+# path -> (mtime, size, sha1), 文件没有变化时不重新计算哈希
+_file_hashes = {}
+
+
+def input_key(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def file_sha1(path):
+    stat = os.stat(path)
+    cached = _file_hashes.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    sha1 = snapshot.file_hash(path)
+    _file_hashes[path] = (stat.st_mtime_ns, stat.st_size, sha1)
+    return sha1
+
+
+class SuspectScoreCache:
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get_or_compute(self, inputs, compute, recompute=False):
+        """
+        Returns (entry, computed): the cached {'inputs', 'created', 'result'} entry for inputs, or a new one from
+        compute() when there is none or recompute is set. Concurrent callers wait instead of computing twice.
+        """
+        key = input_key(inputs)
+        with self._lock:
+            entries = self._load()
+            if not recompute and key in entries:
+                return entries[key], False
+            entry = {'inputs': inputs, 'created': time.time(), 'result': compute()}
+            entries.pop(key, None)
+            entries[key] = entry
+            for old in list(entries)[:-MAX_ENTRIES]:
+                del entries[old]
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f, indent=4)
+            os.replace(tmp_path, self.path)
+            return entry, True
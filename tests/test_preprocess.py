@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+
+from model import preprocess_arrays, preprocess_data
+
+LOCATION_IDS = ['location%d' % i for i in range(8)]
+VOCAB_MAPPING = {location: i + 1 for i, location in enumerate(LOCATION_IDS)}
+BASE_TIME = np.datetime64('2035-02-01T00:00:00', 'us')
+
+
+def as_dicts(ping_arrays):
+    return {vessel_id: [{'time': t, 'dwell': d, 'source': LOCATION_IDS[c]}
+                        for t, d, c in zip(times.tolist(), dwell.tolist(), sources.tolist())]
+            for vessel_id, (times, dwell, sources) in ping_arrays.items()}
+
+
+def vessel(seconds, dwell, sources):
+    times = BASE_TIME + (np.asarray(seconds, dtype=np.float64) * 1e6).astype('timedelta64[us]')
+    return times, np.asarray(dwell, dtype=np.float64), np.asarray(sources, dtype=np.int32)
+
+
+def random_vessels(rng, num_vessels):
+    ping_arrays = {}
+    for v in range(num_vessels):
+        n = int(rng.integers(1, 60))
+        # 包括超过一天的间隔和不足一秒的时间, 覆盖 .seconds 丢掉天数的情况
+        gaps = rng.choice([0, 1, 59, 3599, 3600, 3601, 86399, 86400, 90000, 300000], n) * 1000000
+        gaps += rng.integers(0, 2, n) * rng.integers(0, 1000000, n)
+        times = BASE_TIME + np.cumsum(gaps).astype('timedelta64[us]')
+        dwell = rng.choice([0.0, 0.5, 1.4999995, 3599.9999995, 7200.25, 86400.0, 100000.0, -5.0, 2.5e-7], n)
+        ping_arrays['vessel%d' % v] = (times, dwell, rng.integers(0, len(LOCATION_IDS), n).astype(np.int32))
+    return ping_arrays
+
+
+def assert_same(ping_arrays, time_interval, max_len):
+    ship_mapping = {vessel_id: i for i, vessel_id in enumerate(ping_arrays)}
+    expected = preprocess_data(as_dicts(ping_arrays), VOCAB_MAPPING, ship_mapping, time_interval, max_len)
+    sequences, labels, ship_ids = preprocess_arrays(ping_arrays, LOCATION_IDS, VOCAB_MAPPING, ship_mapping,
+                                                    time_interval, max_len)
+    assert ship_ids == expected[2]
+    assert [seq.tolist() for seq in sequences] == expected[0]
+    assert [seq.tolist() for seq in labels] == expected[1]
+    return sequences, labels
+
+
+@pytest.mark.parametrize('time_interval', [3600, 600, 60, 86400, 7000])
+def test_random_vessels(time_interval):
+    rng = np.random.default_rng(time_interval)
+    for _ in range(20):
+        assert_same(random_vessels(rng, 5), time_interval, int(rng.integers(2, 40)))
+
+
+def test_single_ping():
+    for dwell in (0.0, 1800.0, 7200.0, 100000.0):
+        assert_same({'v': vessel([0], [dwell], [3])}, 3600, 128)
+
+
+def test_empty_vessel():
+    empty = vessel([], [], [])
+    sequences, _ = assert_same({'a': empty, 'b': vessel([0, 3600], [7200, 3600], [1, 2]), 'c': empty}, 3600, 128)
+    assert len(sequences) == 1
+
+
+def test_non_finite_dwell():
+    # 与 preprocess_data 一样由 datetime.timedelta 报错
+    ping_arrays = {'v': vessel([0, 3600], [np.nan, 1.0], [1, 2])}
+    with pytest.raises(ValueError):
+        preprocess_data(as_dicts(ping_arrays), VOCAB_MAPPING, {'v': 0}, 3600, 128)
+    with pytest.raises(ValueError):
+        preprocess_arrays(ping_arrays, LOCATION_IDS, VOCAB_MAPPING, {'v': 0}, 3600, 128)
+
+
+def test_windows_are_views():
+    # 每个 ping 停留 10 小时, 一共约 100 个时间片
+    sequences, labels = assert_same({'v': vessel(np.arange(10) * 36000, [36000] * 10, [1, 2] * 5)}, 3600, 16)
+    assert len(sequences) > 1
+    assert all(np.shares_memory(seq, label) for seq, label in zip(sequences, labels))
@@ -0,0 +1,122 @@
+"""
+Compact columnar binary encoding of the /mc2 trajectory and dwell responses.
+
+Layout, all little-endian. Every numeric array starts at a multiple of 8 bytes from the start of the body, so a
+client can view it in place (e.g. new Float32Array(buffer, offset, 2 * n) in JavaScript):
+
+    header      4s   magic b'MC2C'
+                u2   format version (1)
+                u2   kind: 1 = paths, 2 = dwell, 3 = simplified paths
+                u4   number of vessels
+                u4   padding
+    per vessel  u4   byte length of the UTF-8 vessel id
+                u4   n, the number of pings (paths) or locations (dwell)
+                     vessel id bytes, zero padded to 8 bytes
+      paths     i8[n]   ping times, milliseconds since 1970-01-01 (naive dataset times)
+                f4[2n]  x, y of each ping location, interleaved, zero padded to 8 bytes
+                f8[n]   only for simplified paths: summed dwell of the pings each point stands for
+      dwell     f8[n]   dwell time per location, same unit as the JSON response
+                f4[2n]  x, y of each location, interleaved, zero padded to 8 bytes
+                u4[n]   byte length of each UTF-8 location id, zero padded to 8 bytes
+                        location id bytes, concatenated, zero padded to 8 bytes
+"""
+import struct
+
+import numpy as np
+
+MIMETYPE = 'application/vnd.mc2.columnar'
+MAGIC = b'MC2C'
+VERSION = 1
+KIND_PATHS = 1
+KIND_DWELL = 2
+KIND_SIMPLIFIED_PATHS = 3
+
+_HEADER = struct.Struct('<4sHHII')
+_VESSEL = struct.Struct('<II')
+
+
+def _padded(data):
+    return data + b'\0' * (-len(data) % 8)
+
+
+def _header(kind, count):
+    return _HEADER.pack(MAGIC, VERSION, kind, count, 0)
+
+
+def _vessel(vessel_id, n):
+    name = vessel_id.encode('utf-8')
+    return _VESSEL.pack(len(name), n) + _padded(name)
+
+
+def encode_paths(paths):
+    """
+    Args:
+        paths: list of (vessel id, datetime64 time array, n x 2 coordinate array, dwell array or None), as
+            returned by service.select_vessel_path_columns
+    """
+    simplified = bool(paths) and paths[0][3] is not None
+    parts = [_header(KIND_SIMPLIFIED_PATHS if simplified else KIND_PATHS, len(paths))]
+    for vessel_id, times, points, dwell in paths:
+        parts.append(_vessel(vessel_id, len(times)))
+        parts.append(times.astype('datetime64[ms]').astype('<i8').tobytes())
+        parts.append(_padded(points.astype('<f4').tobytes()))
+        if simplified:
+            parts.append(dwell.astype('<f8').tobytes())
+    return b''.join(parts)
+
+
+def encode_dwells(dwells):
+    """
+    Args:
+        dwells: list of {'vessel': id, 'dwell': {location id: {'time', 'x', 'y'}}}, as returned by
+            service.select_vessel_dwells and service.select_vessel_dwell_windows
+    """
+    parts = [_header(KIND_DWELL, len(dwells))]
+    for item in dwells:
+        dwell = item['dwell']
+        names = [location.encode('utf-8') for location in dwell]
+        values = list(dwell.values())
+        parts.append(_vessel(item['vessel'], len(names)))
+        parts.append(np.array([v['time'] for v in values], dtype='<f8').tobytes())
+        parts.append(_padded(np.array([(v['x'], v['y']) for v in values], dtype='<f4').tobytes()))
+        parts.append(_padded(np.array([len(name) for name in names], dtype='<u4').tobytes()))
+        parts.append(_padded(b''.join(names)))
+    return b''.join(parts)
+
+
+def decode(body):
+    """Reference decoder. Returns (kind, list of per-vessel dicts of NumPy arrays)."""
+    magic, version, kind, count, _ = _HEADER.unpack_from(body, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not an MC2 columnar body (version %d)' % VERSION)
+    offset = _HEADER.size
+    result = []
+
+    def array(dtype, n):
+        nonlocal offset
+        a = np.frombuffer(body, dtype=dtype, count=n, offset=offset)
+        offset += a.nbytes + (-a.nbytes % 8)
+        return a
+
+    for _ in range(count):
+        name_len, n = _VESSEL.unpack_from(body, offset)
+        offset += _VESSEL.size
+        vessel_id = body[offset:offset + name_len].decode('utf-8')
+        offset += name_len + (-name_len % 8)
+        if kind in (KIND_PATHS, KIND_SIMPLIFIED_PATHS):
+            times = array('<i8', n).astype('datetime64[ms]')
+            item = {'vessel': vessel_id, 'time': times, 'point': array('<f4', 2 * n).reshape(n, 2)}
+            if kind == KIND_SIMPLIFIED_PATHS:
+                item['dwell'] = array('<f8', n)
+            result.append(item)
+        else:
+            totals = array('<f8', n)
+            points = array('<f4', 2 * n).reshape(n, 2)
+            lengths = array('<u4', n)
+            locations = []
+            for length in lengths.tolist():
+                locations.append(body[offset:offset + length].decode('utf-8'))
+                offset += length
+            offset += -int(lengths.sum()) % 8
+            result.append({'vessel': vessel_id, 'location': locations, 'time': totals, 'point': points})
+    return kind, result